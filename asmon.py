@@ -3,7 +3,7 @@ import resource
 import os
 import time
 
-from config import TIMEZONE
+from config import TIMEZONE, WORKERS
 from asmon.core import run
 from asmon.alerts import log
 
@@ -26,4 +26,4 @@ def init(timezone=TIMEZONE):
 
 if __name__ == "__main__":
     init()
-    asyncio.run(run(directory=SCRIPT_PATH))
+    asyncio.run(run(directory=SCRIPT_PATH, workers=WORKERS))
@@ -2,4 +2,5 @@ from .commons import log
 from .core import run, checker, SurviveReloadsVar
 from .alerts import alert
 from .metrics import metric
+from .clients import http_client
 from . import useful_checks
@@ -7,52 +7,245 @@ import os
 import json
 import importlib
 import gc
-from dataclasses import dataclass, asdict
+import heapq
+import math
+from collections import defaultdict
 
-from .commons import (log, prefix_to_id_to_alert, prefix_to_str, prefix_ctx,
+from config import ALERT_STORM_THRESHOLD
+
+from .commons import (log, prefix_to_alerts, prefix_to_str, prefix_ctx,
                       file_name_ctx, renotify_ctx, if_in_a_row_ctx,
-                      prefix_to_checks_cnt)
+                      prefix_to_checks_cnt, forwarded_calls_ctx, arg_to_prefix,
+                      checked_prefixes)
 from . import metrics
+from .watcher import watch_directory
 
 
 SEND_ALERTS_FILENAME = "send_alerts.py"
 
-fired_alerts_ctx = contextvars.ContextVar("fired_alerts", default=set())
+# (prefix, alert_id) => if_in_a_row of the alerts fired by the current check
+fired_alerts_ctx = contextvars.ContextVar("fired_alerts", default={})
 
 send_alerts = None  # dynamicaly loaded
 send_alerts_mod_time = 0
 
-@dataclass
+# the index of alerts by time when they can be sent: second => alerts due in it, the due
+# time is rounded down. The due time is kept in the alert, items in other seconds are outdated
+due_buckets = {}
+due_seconds = []  # the heap of due_buckets keys
+due_items_cnt = 0
+
+# sendable alerts of checks which have not run since reload yet
+waiting_alerts = set()
+
+# the sender sleeps until dispatch_time, it is woken earlier if some alert is due before
+dispatch_time = 0
+dispatch_event = asyncio.Event()
+
+# alerts are saved as a snapshot and a journal of changes since the snapshot
+SNAPSHOT_FILENAME = "alerts.json"
+JOURNAL_FILENAME = "alerts.journal"
+
+# alert key => (operation, alert), changes which are not written to the journal yet
+journal_pending = {}
+journal_seq = 0
+journal_records_cnt = 0
+# journal lines which failed to be written, they are written with the next ones
+journal_unwritten = []
+
+# the number of alerts in prefix_to_alerts
+alerts_cnt = 0
+
+# filename => prefixes in prefix_to_alerts
+filename_to_alert_prefixes = defaultdict(set)
+
+# storms are counted over a window, not one send, so a storm spread over the pause of its
+# checker is reported once. After the summary the alerts of the storm wait for the window end
+STORM_WINDOW = 60
+
+# storm key => [window end time, alerts sent in the window, summary sent in the window]
+storm_windows = {}
+
 class Alert:
-    filename: str
-    funcname: str
-    funcarg: object
-    alert_id: str
-    text: str
-    start_time: float
-    last_update_time: float
-    last_send_time: float = 0
-    renotify: float = float("inf")
-    in_a_row: int = 0
-    notify_if_in_a_row: int = 1
-    is_event: bool = False
-    recovered: bool = False
+    """ the prefix tuple is shared with the check and the other alerts of the check """
+    __slots__ = ("prefix", "alert_id", "text", "start_time", "last_update_time",
+                 "last_send_time", "renotify", "in_a_row", "notify_if_in_a_row",
+                 "is_event", "recovered", "due_time")
+
+    # due_time is the place of the alert in the send index, it is not saved
+    FIELDS = ("filename", "funcname", "funcarg") + __slots__[1:-1]
+
+    def __init__(self, filename=None, funcname=None, funcarg=None, alert_id="default",
+                 text="", start_time=0, last_update_time=0, last_send_time=0,
+                 renotify=float("inf"), in_a_row=0, notify_if_in_a_row=1, is_event=False,
+                 recovered=False, prefix=None):
+        self.prefix = prefix if prefix is not None else (filename, funcname, funcarg)
+        self.alert_id = sys.intern(alert_id)
+        self.text = text
+        self.start_time = start_time
+        self.last_update_time = last_update_time
+        self.last_send_time = last_send_time
+        self.renotify = renotify
+        self.in_a_row = in_a_row
+        self.notify_if_in_a_row = notify_if_in_a_row
+        self.is_event = is_event
+        self.recovered = recovered
+        self.due_time = None
+
+    @property
+    def filename(self):
+        return self.prefix[0]
 
     @property
-    def prefix(self):
-        return (self.filename, self.funcname, self.funcarg)
+    def funcname(self):
+        return self.prefix[1]
+
+    @property
+    def funcarg(self):
+        return self.prefix[2]
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __repr__(self):
+        return f"Alert({self.to_dict()!r})"
+
+
+def get_alert(prefix, alert_id):
+    for alert in prefix_to_alerts.get(prefix, ()):
+        if alert.alert_id == alert_id:
+            return alert
+    return None
+
+
+def add_alert(alert):
+    global alerts_cnt
+
+    alerts = prefix_to_alerts.get(alert.prefix, ())
+    old_alert = get_alert(alert.prefix, alert.alert_id)
+    if old_alert is not None:
+        # the replaced alert is not sent
+        old_alert.due_time = None
+        waiting_alerts.discard(old_alert)
+        alerts = tuple(a for a in alerts if a is not old_alert)
+    else:
+        alerts_cnt += 1
+    prefix_to_alerts[alert.prefix] = alerts + (alert,)
+    filename_to_alert_prefixes[alert.filename].add(alert.prefix)
+
+
+def remove_alert(prefix, alert_id):
+    """ returns the removed alert or None """
+    global alerts_cnt
+
+    alert = get_alert(prefix, alert_id)
+    if alert is None:
+        return None
+
+    alerts_cnt -= 1
+    alert.due_time = None
+    alerts = tuple(a for a in prefix_to_alerts[prefix] if a is not alert)
+    if alerts:
+        prefix_to_alerts[prefix] = alerts
+    else:
+        del prefix_to_alerts[prefix]
+        prefixes = filename_to_alert_prefixes[prefix[0]]
+        prefixes.discard(prefix)
+        if not prefixes:
+            del filename_to_alert_prefixes[prefix[0]]
+    return alert
+
+
+def next_send_time(alert):
+    """ returns the time when the alert can be sent or None if it should change before """
+    if alert.last_update_time < alert.last_send_time:
+        return None
+
+    if not alert.recovered and alert.in_a_row < alert.notify_if_in_a_row:
+        return None
+
+    if alert.recovered or alert.last_send_time == 0:
+        return 0
+
+    due_time = alert.last_send_time + alert.renotify
+    return due_time if due_time != float("inf") else None
+
+
+def index_alert(alert):
+    """ should be called after every change of the alert """
+    due_time = next_send_time(alert)
+    if due_time is None or alert.due_time == due_time:
+        return
+    add_to_due_index(alert, due_time)
+
+
+def add_to_due_index(alert, due_time):
+    global due_items_cnt
+
+    alert.due_time = due_time
+    second = math.floor(due_time)
+    if second not in due_buckets:
+        due_buckets[second] = []
+        heapq.heappush(due_seconds, second)
+    due_buckets[second].append(alert)
+    due_items_cnt += 1
+
+    if second < dispatch_time:
+        dispatch_event.set()
+
+
+def is_due_in(alert, second):
+    return alert.due_time is not None and math.floor(alert.due_time) == second
+
+
+def compact_due_index():
+    global due_seconds
+    global due_items_cnt
+
+    for second, alerts in list(due_buckets.items()):
+        # an alert can be indexed twice in one second
+        alerts = list(dict.fromkeys(a for a in alerts if is_due_in(a, second)))
+        if alerts:
+            due_buckets[second] = alerts
+        else:
+            del due_buckets[second]
+
+    due_seconds = list(due_buckets)
+    heapq.heapify(due_seconds)
+    due_items_cnt = sum(map(len, due_buckets.values()))
+
+
+def journal_alert(alert, op):
+    """ should be called after every change of the alert, op is create, update, recover or delete """
+    key = (alert.prefix, alert.alert_id)
+    pending_op = journal_pending.get(key, (None, None))[0]
+
+    if pending_op == "create":
+        if op == "delete":
+            # the alert was never written
+            del journal_pending[key]
+            return
+        op = "create"
+    elif pending_op == "delete" and op == "create":
+        op = "update"
+
+    journal_pending[key] = (op, alert)
 
 
 def alerts_precheck_hook(args_str):
-    fired_alerts_ctx.set(set())
+    fired_alerts_ctx.set({})
 
 
 def alerts_postcheck_hook():
-    active = [a for a in prefix_to_id_to_alert[prefix_ctx.get()].values()]
+    # no empty dicts for prefixes without alerts
+    active = []
+    for prefix in checked_prefixes():
+        active.extend(prefix_to_alerts.get(prefix, ()))
+        metrics.mark_dirty(prefix)
 
     # if alert not fired during the check, recover it
     for alert in active:
-        if alert.alert_id not in fired_alerts_ctx.get():
+        if (alert.prefix, alert.alert_id) not in fired_alerts_ctx.get():
             if alert.is_event:
                 continue
 
@@ -62,98 +255,240 @@ def alerts_postcheck_hook():
             # if alert flaps, remove it
             if alert.in_a_row < alert.notify_if_in_a_row:
                 delete_alert(alert)
+            else:
+                index_alert(alert)
+                journal_alert(alert, "recover")
 
 
-def recover_alerts(filename, unregistered_only=False):
-    global prefix_to_checks_cnt
+def alerts_fired():
+    return bool(fired_alerts_ctx.get())
+
+
+def fired_alerts_threshold():
+    """ the largest if_in_a_row of the alerts fired by the check, 0 if none were fired """
+    return max(fired_alerts_ctx.get().values(), default=0)
 
-    for id_to_alert in prefix_to_id_to_alert.values():
-        for alert in id_to_alert.values():
-            if alert.filename != filename:
-                continue
 
+def recover_alerts(filename, unregistered_only=False, keep_funcnames=()):
+    global prefix_to_checks_cnt
+
+    for prefix in filename_to_alert_prefixes.get(filename, ()):
+        if prefix[1] in keep_funcnames:
+            continue
+        for alert in prefix_to_alerts[prefix]:
             if alert.is_event:
                 continue
 
             if alert.prefix not in prefix_to_checks_cnt or not unregistered_only:
                 alert.last_update_time = time.time()
                 alert.recovered = True
+                index_alert(alert)
+                journal_alert(alert, "recover")
 
 
-def alert(text, alert_id="default", renotify=None, if_in_a_row=None, event=False):
+def alert(text, alert_id="default", renotify=None, if_in_a_row=None, event=False, arg=None):
+    """ fires the alert of the check, batch checks can fire it for their arg """
     if not file_name_ctx.get():
         # if script runs directly, do nothing
         log(text)
         return
 
+    prefix = prefix_ctx.get() if arg is None else arg_to_prefix(arg)
+    alert_id = str(alert_id)
+    fired_if_in_a_row = if_in_a_row if if_in_a_row is not None else if_in_a_row_ctx.get()
+    fired_alerts_ctx.get()[(prefix, alert_id)] = 1 if event else fired_if_in_a_row
+
+    forwarded_calls = forwarded_calls_ctx.get()
+    if forwarded_calls is not None:
+        kwargs = {"renotify": renotify, "if_in_a_row": if_in_a_row, "event": event, "arg": arg}
+        forwarded_calls.append(("alert", (text, alert_id), kwargs))
+        return
+
     if if_in_a_row is None:
         if_in_a_row = if_in_a_row_ctx.get()
 
-    alert_id = str(alert_id)
-    fired_alerts_ctx.get().add(alert_id)
-
     if renotify is None:
         renotify = renotify_ctx.get()
 
-    prefix = prefix_ctx.get()
-    id_to_alert = prefix_to_id_to_alert[prefix]
-    filename, funcname, funcarg = prefix
-
     if event:
         renotify = False
         if_in_a_row = 1
-        alert_id = f"__event{len(id_to_alert)}__"
-
-    if alert_id not in id_to_alert:
-        id_to_alert[alert_id] = Alert(alert_id=alert_id, text=text, filename=filename,
-                                      funcname=funcname, funcarg=funcarg,
-                                      start_time=time.time(),
-                                      last_update_time=time.time(), last_send_time=0,
-                                      renotify=renotify, in_a_row=1,
-                                      notify_if_in_a_row=if_in_a_row, is_event=event,
-                                      recovered=False)
+        alert_id = f"__event{len(prefix_to_alerts.get(prefix, ()))}__"
+
+    a = get_alert(prefix, alert_id)
+    if a is None:
+        cur_time = time.time()
+        new_alert = Alert(prefix=prefix, alert_id=alert_id, text=text,
+                          start_time=cur_time,
+                          last_update_time=cur_time, last_send_time=0,
+                          renotify=renotify, in_a_row=1,
+                          notify_if_in_a_row=if_in_a_row, is_event=event,
+                          recovered=False)
+        add_alert(new_alert)
+        metrics.mark_dirty(prefix)
+        journal_alert(new_alert, "create")
+        a = new_alert
     else:
-        id_to_alert[alert_id].text = text
-        id_to_alert[alert_id].last_update_time = time.time()
-        id_to_alert[alert_id].renotify = renotify
-        id_to_alert[alert_id].in_a_row += 1
-        id_to_alert[alert_id].notify_if_in_a_row = if_in_a_row
-        id_to_alert[alert_id].recovered = False
+        # refires of a firing alert are not journaled, the restored alert would be the same
+        changed = (a.text != text or a.renotify != renotify or a.recovered or
+                   a.notify_if_in_a_row != if_in_a_row or a.in_a_row < a.notify_if_in_a_row)
+        a.text = text
+        a.last_update_time = time.time()
+        a.renotify = renotify
+        a.in_a_row += 1
+        a.notify_if_in_a_row = if_in_a_row
+        a.recovered = False
+        if changed:
+            journal_alert(a, "update")
+
+    index_alert(a)
 
 
 def get_sendable_alerts():
+    global due_items_cnt
+
     sendable_alerts = []
 
     cur_time = time.time()
-    for id_to_alert in prefix_to_id_to_alert.values():
-        for a in id_to_alert.values():
-            if not a.recovered and not prefix_to_checks_cnt[a.prefix] and a.prefix[1] != "__loading__":
-                # there was no checks after reloading
-                continue
-
-            if a.last_update_time < a.last_send_time:
-                # the alert is not updated since the last report
-                continue
 
-            if not a.recovered and a.in_a_row < a.notify_if_in_a_row:
-                # the alert is not fired enough
-                continue
-
-            if (a.recovered or a.last_send_time == 0 or
-                    a.last_send_time + a.renotify < cur_time):
-                sendable_alerts.append(a)
+    if due_items_cnt > 2 * alerts_cnt + 1000:
+        # too many outdated items
+        compact_due_index()
+
+    alerts = set(waiting_alerts)
+    waiting_alerts.clear()
+    while due_seconds and due_seconds[0] <= cur_time:
+        second = due_seconds[0]
+        # an alert can be indexed twice in one second
+        bucket = list(dict.fromkeys(a for a in due_buckets[second] if is_due_in(a, second)))
+        not_due = [a for a in bucket if a.due_time > cur_time]
+        for a in bucket:
+            if a.due_time <= cur_time:
+                a.due_time = None
+                alerts.add(a)
+
+        due_items_cnt -= len(due_buckets[second]) - len(not_due)
+        if not_due:
+            # the current second, the next ones are not due too
+            due_buckets[second] = not_due
+            break
+        heapq.heappop(due_seconds)
+        del due_buckets[second]
+
+    for a in alerts:
+        if get_alert(a.prefix, a.alert_id) is not a:
+            # deleted or replaced
+            continue
+
+        if not a.recovered and not prefix_to_checks_cnt[a.prefix] and a.prefix[1] != "__loading__":
+            # there was no checks after reloading
+            waiting_alerts.add(a)
+            continue
+
+        if a.last_update_time < a.last_send_time:
+            # the alert is not updated since the last report
+            continue
+
+        if not a.recovered and a.in_a_row < a.notify_if_in_a_row:
+            # the alert is not fired enough
+            continue
+
+        if (a.recovered or a.last_send_time == 0 or
+                a.last_send_time + a.renotify < cur_time):
+            sendable_alerts.append(a)
+        else:
+            index_alert(a)
 
     sendable_alerts.sort(key=lambda k: (k.recovered, k.last_send_time, k.start_time))
     return sendable_alerts
 
 
+def hold_alert(alert, until):
+    """ the alert is not sent until the time, unless it changes before """
+    add_to_due_index(alert, until)
+
+
+def get_storm_key(alert):
+    return (alert.filename, alert.funcname, alert.alert_id, alert.recovered, alert.is_event,
+            alert.last_send_time == 0)
+
+
+def aggregate_storms(alerts):
+    """ replaces many similar alerts of one checker with a summary alert, returns alerts
+        to send, the summary alert => its alerts dict and the set of held alerts """
+    SAMPLE_ARGS = 5
+
+    cur_time = time.time()
+    for key, (window_end, _, _) in list(storm_windows.items()):
+        if window_end <= cur_time:
+            del storm_windows[key]
+
+    groups = defaultdict(list)
+    for alert in alerts:
+        groups[get_storm_key(alert)].append(alert)
+
+    alerts_to_send = []
+    summary_to_alerts = {}
+    held_alerts = set()
+    for storm_key, group in groups.items():
+        filename, funcname, alert_id, recovered, is_event, is_new = storm_key
+        if not ALERT_STORM_THRESHOLD:
+            alerts_to_send += group
+            continue
+
+        window = storm_windows.setdefault(storm_key, [cur_time + STORM_WINDOW, 0, False])
+        window_end, sent_cnt, summary_sent = window
+        if sent_cnt + len(group) <= ALERT_STORM_THRESHOLD:
+            window[1] += len(group)
+            alerts_to_send += group
+            continue
+
+        if summary_sent:
+            for alert in group:
+                hold_alert(alert, window_end)
+            held_alerts.update(group)
+            continue
+
+        # the window is marked when the summary is delivered, see send_new_alerts
+        args = list(dict.fromkeys(alert.funcarg for alert in group))
+        sample = ", ".join(str(arg) for arg in args[:SAMPLE_ARGS])
+        if len(args) > SAMPLE_ARGS:
+            sample += f" и еще {len(args) - SAMPLE_ARGS}"
+
+        summary = Alert(prefix=(filename, funcname, None), alert_id="__storm__",
+                        text=f"{filename}:{funcname} для {len(args)} аргументов ({sample}): "
+                             f"{group[0].text}",
+                        start_time=min(alert.start_time for alert in group),
+                        last_update_time=max(alert.last_update_time for alert in group),
+                        last_send_time=0 if is_new else min(a.last_send_time for a in group),
+                        is_event=is_event, recovered=recovered)
+        alerts_to_send.append(summary)
+        summary_to_alerts[summary] = group
+
+    alerts_to_send.sort(key=lambda k: (k.recovered, k.last_send_time, k.start_time))
+    return alerts_to_send, summary_to_alerts, held_alerts
+
+
 async def send_new_alerts():
     sendable_alerts = get_sendable_alerts()
+    alerts_to_send, summary_to_alerts, held_alerts = aggregate_storms(sendable_alerts)
+    if held_alerts:
+        # the held alerts are not failed sends, they are indexed by hold_alert
+        sendable_alerts = [alert for alert in sendable_alerts if alert not in held_alerts]
     send_start_time = time.time()
 
     try:
-        await send_alerts(sendable_alerts)
+        await send_alerts(alerts_to_send)
     finally:
+        for summary, alerts in summary_to_alerts.items():
+            if summary.last_send_time >= send_start_time:
+                # the next alerts of the storm wait for the window end
+                window = storm_windows.get(get_storm_key(alerts[0]))
+                if window:
+                    window[2] = True
+                for alert in alerts:
+                    alert.last_send_time = summary.last_send_time
+
         sucessful_cnt = 0
         for alert in sendable_alerts:
             if alert.last_send_time >= send_start_time:
@@ -170,13 +505,16 @@ async def send_new_alerts():
             ready_to_del = (alert.recovered or alert.is_event)
             if was_sent and ready_to_del:
                 delete_alert(alert)
+            else:
+                index_alert(alert)
+                if was_sent:
+                    journal_alert(alert, "update")
 
 
 def delete_alert(alert):
-    if alert.alert_id in prefix_to_id_to_alert[alert.prefix]:
-        del prefix_to_id_to_alert[alert.prefix][alert.alert_id]
-        if not prefix_to_id_to_alert[alert.prefix]:
-            del prefix_to_id_to_alert[alert.prefix]
+    if remove_alert(alert.prefix, alert.alert_id):
+        journal_alert(alert, "delete")
+        metrics.mark_dirty(alert.prefix)
 
 
 def try_reload_send_alerts(directory):
@@ -203,8 +541,32 @@ def try_reload_send_alerts(directory):
     gc.collect()
 
 
+async def wait_for_sendable_alerts(max_pause):
+    """ sleeps until the next alert is due, but no longer than max_pause """
+    global dispatch_time
+
+    # alerts fired together are sent together
+    COALESCE_PAUSE = 1
+
+    dispatch_time = time.time() + max_pause
+    if due_seconds:
+        dispatch_time = min(dispatch_time, due_seconds[0])
+
+    dispatch_event.clear()
+    try:
+        await asyncio.wait_for(dispatch_event.wait(), max(0, dispatch_time - time.time()))
+        await asyncio.sleep(COALESCE_PAUSE)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        dispatch_time = 0
+
+
 async def alert_sender_loop():
+    # the pause after failed sends and to check alerts waiting for their checks to run
     ALERT_PAUSE = 10
+    # the pause when there are no alerts to send
+    MAX_ALERT_PAUSE = 60 * 60
     while True:
         try:
             await send_new_alerts()
@@ -212,20 +574,32 @@ async def alert_sender_loop():
             traceback.print_exc()
             metrics.exceptions_cnt["alert_sender"] += 1
         finally:
-            await asyncio.sleep(ALERT_PAUSE)
+            if metrics.send_alert_queue_size:
+                await asyncio.sleep(ALERT_PAUSE)
+            elif waiting_alerts:
+                await wait_for_sendable_alerts(ALERT_PAUSE)
+            else:
+                await wait_for_sendable_alerts(MAX_ALERT_PAUSE)
 
 
 async def send_alert_reloader_loop(directory):
     global send_alerts
 
     RELOAD_PAUSE = 10
+    # with inotify the file is checked only in case some events were lost
+    PAUSE_FULL_RELOADS = 60
+
+    watcher = watch_directory(directory, lambda f: f == SEND_ALERTS_FILENAME)
     while True:
         try:
             try_reload_send_alerts(directory)
         except Exception:
             traceback.print_exc()
         finally:
-            await asyncio.sleep(RELOAD_PAUSE)
+            if watcher:
+                await watcher.wait_changes(PAUSE_FULL_RELOADS)
+            else:
+                await asyncio.sleep(RELOAD_PAUSE)
 
 
 async def alert_stats_loop():
@@ -235,7 +609,7 @@ async def alert_stats_loop():
             if prefix_to_checks_cnt:
                 log(f"Stats:")
             for prefix, checks_count in prefix_to_checks_cnt.items():
-                alerts_count = len(prefix_to_id_to_alert[prefix])
+                alerts_count = len(prefix_to_alerts.get(prefix, ()))
                 str_prefix = prefix_to_str(prefix)
                 log(f" {str_prefix} {checks_count} checks, {alerts_count} active alerts")
         except Exception:
@@ -245,36 +619,145 @@ async def alert_stats_loop():
             await asyncio.sleep(STATS_PAUSE)
 
 
+def write_journal(lines):
+    with open(JOURNAL_FILENAME, "a") as file:
+        file.writelines(lines)
+
+
+def write_snapshot(lines):
+    with open(SNAPSHOT_FILENAME + ".tmp", "w") as file:
+        file.writelines(lines)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.rename(SNAPSHOT_FILENAME + ".tmp", SNAPSHOT_FILENAME)
+
+    # all journal records are in the snapshot now
+    open(JOURNAL_FILENAME, "w").close()
+
+
+def make_journal_lines():
+    global journal_seq
+
+    lines = []
+    for (prefix, alert_id), (op, alert) in journal_pending.items():
+        if op == "delete":
+            record = {"seq": journal_seq + 1, "op": op, "prefix": prefix, "alert_id": alert_id}
+        else:
+            record = {"seq": journal_seq + 1, "op": op, "alert": alert.to_dict()}
+
+        try:
+            lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+            journal_seq += 1
+        except Exception:
+            traceback.print_exc()
+            metrics.exceptions_cnt["alert_saver"] += 1
+
+    journal_pending.clear()
+    return lines
+
+
+async def make_snapshot_lines():
+    lines = [json.dumps({"journal_seq": journal_seq}) + "\n"]
+    for num, alerts in enumerate(list(prefix_to_alerts.values())):
+        for alert in alerts:
+            lines.append(json.dumps(alert.to_dict(), ensure_ascii=False) + "\n")
+
+        if num % 1000 == 999:
+            # don't block the loop for long, changes are in the journal anyway
+            await asyncio.sleep(0)
+    return lines
+
+
 async def alert_save_loop():
-    SAVE_PAUSE = 60
+    JOURNAL_PAUSE = 1
+    COMPACT_PAUSE = 60 * 60
+    MIN_JOURNAL_RECORDS_TO_COMPACT = 10000
+
+    global journal_records_cnt
+
+    last_compact_time = time.time()
     while True:
         try:
-            with open("alerts.json.tmp", "w") as file:
-                for id_to_alert in prefix_to_id_to_alert.values():
-                    for alert in id_to_alert.values():
-                        file.write(json.dumps(asdict(alert), ensure_ascii=False) + "\n")
-
-            os.rename("alerts.json.tmp", "alerts.json")
+            if journal_pending or journal_unwritten:
+                # the lines are kept until they are written, a failed write is retried
+                journal_unwritten.extend(make_journal_lines())
+                await asyncio.to_thread(write_journal, journal_unwritten)
+                journal_records_cnt += len(journal_unwritten)
+                journal_unwritten.clear()
+
+            compact_time = (journal_records_cnt and
+                            time.time() - last_compact_time > COMPACT_PAUSE)
+            journal_too_big = (journal_records_cnt > MIN_JOURNAL_RECORDS_TO_COMPACT and
+                               journal_records_cnt > 10 * alerts_cnt)
+            if compact_time or journal_too_big:
+                lines = await make_snapshot_lines()
+                await asyncio.to_thread(write_snapshot, lines)
+                journal_records_cnt = 0
+                last_compact_time = time.time()
         except Exception:
             traceback.print_exc()
             metrics.exceptions_cnt["alert_saver"] += 1
         finally:
-            await asyncio.sleep(SAVE_PAUSE)
+            await asyncio.sleep(JOURNAL_PAUSE)
+
+
+def load_alert(alert_dict, prefixes):
+    """ prefixes is the dict to share equal prefix tuples between loaded alerts """
+    prefix = (alert_dict.pop("filename"), alert_dict.pop("funcname"), alert_dict.pop("funcarg"))
+    alert = Alert(prefix=prefixes.setdefault(prefix, prefix), **alert_dict)
+    add_alert(alert)
+    metrics.mark_dirty(alert.prefix)
+    index_alert(alert)
 
 
 def load_alerts():
+    global journal_seq
+    global journal_records_cnt
+
+    prefixes = {}
+    snapshot_seq = 0
     try:
         loaded = 0
-        with open("alerts.json") as file:
+        with open(SNAPSHOT_FILENAME) as file:
             for line in file:
                 try:
                     alert_dict = json.loads(line)
-                    alert = Alert(**alert_dict)
-                    prefix_to_id_to_alert[alert.prefix][alert.alert_id] = alert
+                    if "journal_seq" in alert_dict:
+                        snapshot_seq = alert_dict["journal_seq"]
+                        continue
+                    load_alert(alert_dict, prefixes)
                     loaded +=1
                 except Exception as E:
-                    log(f"bad line in alerts.json, {E}: {line}")
-            log(f"loaded {loaded} alerts from alerts.json")
+                    log(f"bad line in {SNAPSHOT_FILENAME}, {E}: {line}")
+            log(f"loaded {loaded} alerts from {SNAPSHOT_FILENAME}")
+    except FileNotFoundError:
+        pass
+    except Exception:
+        traceback.print_exc()
+
+    journal_seq = snapshot_seq
+    try:
+        replayed = 0
+        with open(JOURNAL_FILENAME) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                    journal_seq = max(journal_seq, record["seq"])
+                    journal_records_cnt += 1
+                    if record["seq"] <= snapshot_seq:
+                        continue
+
+                    if record["op"] == "delete":
+                        prefix = tuple(record["prefix"])
+                        remove_alert(prefix, record["alert_id"])
+                        metrics.mark_dirty(prefix)
+                    else:
+                        load_alert(record["alert"], prefixes)
+                    replayed += 1
+                except Exception as E:
+                    log(f"bad line in {JOURNAL_FILENAME}, {E}: {line}")
+            log(f"replayed {replayed} records from {JOURNAL_FILENAME}")
     except FileNotFoundError:
         pass
     except Exception:
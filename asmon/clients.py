@@ -0,0 +1,59 @@
+# pooled http clients for checks, they survive reloads and are closed when the file is deleted
+import asyncio
+import functools
+from collections import defaultdict
+
+from .commons import file_name_ctx
+from . import metrics
+
+# the connections limit of a client, use a client per host to limit connections per host
+MAX_CONNECTIONS = 100
+MAX_KEEPALIVE_CONNECTIONS = 20
+
+# (filename, key) => httpx.AsyncClient
+clients = {}
+filename_to_client_keys = defaultdict(set)
+
+# don't let closing tasks to be garbage collected
+closing_tasks = set()
+
+
+async def count_request(filename, request):
+    metrics.http_requests[filename] += 1
+    request.extensions.setdefault("trace", functools.partial(trace_connection, filename))
+
+
+async def trace_connection(filename, event_name, info):
+    if event_name == "connection.connect_tcp.started":
+        metrics.http_connects[filename] += 1
+
+
+def http_client(key=None, max_connections=MAX_CONNECTIONS, **kwargs):
+    """ returns the httpx.AsyncClient of the check file, reusing connections between runs.
+        Clients with different keys, like hosts, have separate pools and limits.
+        Other arguments are passed to httpx.AsyncClient when the client is created """
+    import httpx
+
+    filename = file_name_ctx.get()
+    client = clients.get((filename, key))
+    if client is None or client.is_closed:
+        limits = httpx.Limits(max_connections=max_connections,
+                              max_keepalive_connections=min(max_connections,
+                                                            MAX_KEEPALIVE_CONNECTIONS))
+        hooks = {"request": [functools.partial(count_request, filename)]}
+        client = httpx.AsyncClient(limits=limits, event_hooks=hooks, **kwargs)
+        clients[(filename, key)] = client
+        filename_to_client_keys[filename].add(key)
+    return client
+
+
+def close_clients(filename):
+    for key in filename_to_client_keys.pop(filename, ()):
+        client = clients.pop((filename, key))
+        if not client.is_closed:
+            task = asyncio.create_task(client.aclose())
+            closing_tasks.add(task)
+            task.add_done_callback(closing_tasks.discard)
+
+    metrics.http_requests.pop(filename, None)
+    metrics.http_connects.pop(filename, None)
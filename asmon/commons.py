@@ -4,8 +4,9 @@ import sys
 from contextvars import ContextVar
 from collections import defaultdict, Counter
 
-# used by alerts and metrics
-prefix_to_id_to_alert = defaultdict(dict)
+# used by alerts and metrics, prefix => tuple of its alerts. A check has one or a few alerts,
+# so a tuple searched by alert_id is much smaller than a dict per prefix
+prefix_to_alerts = {}
 
 # mapping from filename to tasks list, used by core and metrics
 filename_to_tasks = defaultdict(list)
@@ -13,9 +14,15 @@ filename_to_tasks = defaultdict(list)
 # prefix to checks counter, used by core and metrics
 prefix_to_checks_cnt = Counter()
 
+# filename to prefixes in prefix_to_checks_cnt
+filename_to_prefixes = defaultdict(set)
+
 # prefix is a (file_name, function_name, arg)
 prefix_ctx = ContextVar("prefix", default="")
 
+# arg => prefix of the args of the running batch check
+batch_prefixes_ctx = ContextVar("batch_prefixes", default=None)
+
 # just a file_name
 file_name_ctx = ContextVar("file_name", default="")
 
@@ -25,6 +32,30 @@ renotify_ctx = ContextVar("renotify", default=float("inf"))
 # the setable value of a number in a row the alert should happen to notify
 if_in_a_row_ctx = ContextVar("if_in_a_row", default=1)
 
+# if set, alert and metric calls are recorded here to be replayed in the main process
+forwarded_calls_ctx = ContextVar("forwarded_calls", default=None)
+
+
+def register_prefix(prefix):
+    prefix_to_checks_cnt[prefix] = 0
+    filename_to_prefixes[prefix[0]].add(prefix)
+
+
+def arg_to_prefix(arg):
+    """ returns the prefix of the arg of the running batch check """
+    batch_prefixes = batch_prefixes_ctx.get()
+    if batch_prefixes is None or arg not in batch_prefixes:
+        raise ValueError(f"{arg!r} is not an arg of the running batch check")
+    return batch_prefixes[arg]
+
+
+def checked_prefixes():
+    """ the prefix of the running check and the prefixes of its batch args """
+    batch_prefixes = batch_prefixes_ctx.get()
+    if batch_prefixes is None:
+        return [prefix_ctx.get()]
+    return [prefix_ctx.get(), *batch_prefixes.values()]
+
 
 def prefix_to_str(prefix):
     if len(prefix) == 3 and not prefix[2]:
@@ -5,125 +5,668 @@ import traceback
 import os
 import re
 import gc
+import heapq
+import itertools
+import math
+import zlib
 import importlib.util
+import inspect
+import types
+import contextvars
 from collections import defaultdict
+from contextlib import AsyncExitStack
 from contextvars import ContextVar
 
+from config import MAX_CONCURRENT_CHECKS, MAX_CONCURRENT_CHECKS_PER_FILE
+
 from .commons import (log, prefix_to_str, prefix_ctx, file_name_ctx,
                       renotify_ctx, if_in_a_row_ctx, filename_to_tasks,
-                      prefix_to_checks_cnt)
+                      prefix_to_checks_cnt, filename_to_prefixes, register_prefix,
+                      forwarded_calls_ctx, batch_prefixes_ctx, checked_prefixes)
 from .alerts import (alert, alerts_precheck_hook, alerts_postcheck_hook, load_alerts,
                      alert_sender_loop, alert_stats_loop, alert_save_loop, recover_alerts,
+                     alerts_fired, fired_alerts_threshold,
                      try_reload_send_alerts, send_alert_reloader_loop)
-from .metrics import (metrics_precheck_hook, metrics_postcheck_hook, exceptions_cnt,
-                      start_metrics_srv)
+from .metrics import (metric, metrics_precheck_hook, metrics_postcheck_hook, exceptions_cnt,
+                      schedule_lag, checks_in_flight, checks_queued, mark_dirty,
+                      observe_check, observe_blocking, observe_interval, forget_check,
+                      forget_checker, observe_reload, forget_reload, http_requests, http_connects,
+                      loop_lag_loop, loop_lag, active_tasks, start_metrics_srv)
+from . import workers
+from .workers import (in_shard, spawn_worker, connect_to_parent, send_to_parent, drain_parent,
+                      read_msg)
+from .watcher import watch_directory
+from .clients import close_clients
+from .executors import EXECUTORS, run_in_thread, run_in_process
 
 next_allowed_run = defaultdict(int)
 
 reload_survivers = {}
+filename_to_survivor_names = defaultdict(set)
+
+# limits of simultaneously running checks
+global_limit = asyncio.Semaphore(MAX_CONCURRENT_CHECKS) if MAX_CONCURRENT_CHECKS else None
+filename_to_limit = {}
+func_to_limit = defaultdict(dict)  # filename => funcname => semaphore
+
+# registrations of checkers while the module is loading in a thread
+pending_checkers_ctx = ContextVar("pending_checkers", default=None)
+pending_sources_ctx = ContextVar("pending_sources", default=None)
+
+# args sources by filename, their calls are limited by this timeout
+filename_to_sources = defaultdict(list)
+ARGS_SOURCE_TIMEOUT = 60
+# while a source has given no args, it is called again after this pause
+ARGS_RETRY_PAUSE = 10
 
-async def throttle_runs(key, pps):
+
+def reserve_run_slot(key, pps, cur_time):
+    """ returns the time when the run is allowed, reserving this time slot """
     global next_allowed_run
 
     if pps == 0:
-        return
+        return cur_time
     next_time = 1.0 / pps
 
-    cur_time = time.time()
-
-    wait_time = next_allowed_run[key] - cur_time
-    if wait_time < 0:
+    if next_allowed_run[key] < cur_time:
         next_allowed_run[key] = cur_time + next_time
-        return
+        return cur_time
 
     next_allowed_run[key] += next_time
-    await asyncio.sleep(wait_time)
+    return next_allowed_run[key] - next_time
+
+
+class Check:
+    """ A registered check. It has no task while it waits for the next run """
+    __slots__ = ("func", "args", "pause", "prefix", "renotify", "max_starts_per_sec",
+                 "timeout", "if_in_a_row", "fixed_rate", "limits", "params", "batch",
+                 "executor", "min_pause", "max_pause", "interval", "failures", "due_time",
+                 "task", "throttled", "cancelled")
+
+    def __init__(self, func, args, pause, prefix, renotify, max_starts_per_sec,
+                 timeout, if_in_a_row, fixed_rate, limits, params, batch=None, executor=None,
+                 min_pause=None, max_pause=None):
+        self.func = func
+        self.args = args
+        self.pause = pause
+        # the pause adapts between min_pause and max_pause
+        self.min_pause = pause if min_pause is None else min_pause
+        self.max_pause = pause if max_pause is None else max_pause
+        self.interval = pause  # the current pause
+        self.failures = 0  # runs with alerts in a row
+        self.prefix = prefix
+        self.renotify = renotify
+        self.max_starts_per_sec = max_starts_per_sec
+        self.timeout = timeout
+        self.if_in_a_row = if_in_a_row
+        self.fixed_rate = fixed_rate
+        self.limits = limits  # semaphores to acquire before the run
+        self.params = params  # the decorator parameters, to find changed checkers on reload
+        self.batch = batch  # arg => prefix of the args of a batch check
+        self.executor = executor  # the pool to run the sync func in
+        self.due_time = 0  # when the run should start, without throttling
+        self.task = None  # the task of the current run
+        self.throttled = False  # the start slot is already reserved
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        if self.task:
+            self.task.cancel()
+        # the check can stay in the scheduler heap for a while, don't hold the module
+        self.func = self.args = None
+
+    def is_adaptive(self):
+        return self.min_pause != self.pause or self.max_pause != self.pause
+
+    def prefixes(self):
+        """ the prefix of the check and the prefixes of its batch args """
+        if self.batch is None:
+            return [self.prefix]
+        return [self.prefix, *self.batch.values()]
+
+
+class Scheduler:
+    """ Keeps checks in a heap by their due time and starts a task when a check is due """
+    def __init__(self):
+        self.heap = []
+        self.seq = itertools.count()
+        self.stale = 0  # cancelled checks which are still in the heap
+        self.wakeup = asyncio.Event()
+
+    def add(self, check, due_time):
+        check.due_time = due_time
+        self.push(check, due_time)
+
+    def push(self, check, due_time):
+        heapq.heappush(self.heap, (due_time, next(self.seq), check))
+        if self.heap[0][2] is check:
+            self.wakeup.set()
+
+    def forget(self, checks):
+        """ called before the checks are cancelled, only the waiting ones are in the heap """
+        self.stale += sum(1 for check in checks if check.task is None)
+        if self.stale > len(self.heap) // 2:
+            self.heap = [e for e in self.heap if not e[2].cancelled]
+            heapq.heapify(self.heap)
+            self.stale = 0
+
+    async def loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            cur_time = loop.time()
+            while self.heap and self.heap[0][0] <= cur_time:
+                due_time, _, check = heapq.heappop(self.heap)
+                if check.cancelled:
+                    self.stale = max(0, self.stale - 1)
+                    continue
 
+                if check.max_starts_per_sec and not check.throttled:
+                    throttler_key = check.prefix[:2]  # file and func
+                    start_time = reserve_run_slot(throttler_key, check.max_starts_per_sec,
+                                                  cur_time)
+                    if start_time > cur_time:
+                        check.throttled = True
+                        self.push(check, start_time)
+                        continue
+                check.throttled = False
+
+                schedule_lag[check.prefix] = cur_time - check.due_time
+                check.task = asyncio.create_task(run_check(check))
+
+            self.wakeup.clear()
+            timer = None
+            if self.heap:
+                timer = loop.call_at(self.heap[0][0], self.wakeup.set)
+            await self.wakeup.wait()
+            if timer:
+                timer.cancel()
+
+
+scheduler = Scheduler()
+
+# steps of checks longer than this are counted as blocking the event loop
+BLOCKING_STEP = 0.1
+# if a step of a check is longer than this, the __blocking__ alert is fired
+BLOCKING_ALERT_STEP = 1
+
+# healthy adaptive checks get this times longer pause after every run
+PAUSE_GROWTH = 1.5
+
+
+class TimedSteps:
+    """ Awaits the coroutine and measures how long its every step holds the event loop """
+    def __init__(self, coro):
+        self.coro = coro
+        self.blocked = 0  # the total time of blocking steps
+        self.longest = 0
+
+    def account(self, start_time):
+        step = time.perf_counter() - start_time
+        if step > BLOCKING_STEP:
+            self.blocked += step
+        self.longest = max(self.longest, step)
+
+    def __await__(self):
+        coro = self.coro
+        to_send = to_throw = None
+        while True:
+            start_time = time.perf_counter()
+            try:
+                if to_throw is None:
+                    result = coro.send(to_send)
+                else:
+                    result = coro.throw(to_throw)
+            except StopIteration as e:
+                self.account(start_time)
+                return e.value
+            except BaseException:
+                self.account(start_time)
+                raise
+            self.account(start_time)
+
+            to_send = to_throw = None
+            try:
+                to_send = yield result
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e:
+                to_throw = e
 
 
-async def run_checkloop(check_func, args, pause, alert_prefix,
-                        renotify, max_starts_per_sec,
-                        timeout, if_in_a_row):
-    prefix_ctx.set(alert_prefix)
-    renotify_ctx.set(renotify)
-    if_in_a_row_ctx.set(if_in_a_row)
+def alert_if_blocking(steps, alert_prefix):
+    if not steps or steps.longest <= BLOCKING_ALERT_STEP:
+        return
 
-    await throttle_runs("start_check", 25)
+    filename, funcname, parameter = alert_prefix
+    msg = f"проверка {filename}:{funcname} блокирует event loop на {steps.longest:.1f} сек."
+    if parameter is not None:
+        msg += f"({parameter})"
 
-    throttler_key = tuple(alert_prefix[:2])  # file and func
+    alert(msg, "__blocking__")
 
-    while True:
-        try:
-            await throttle_runs(throttler_key, max_starts_per_sec)
+
+async def run_check(check):
+    alert_prefix = check.prefix
+    args = check.args
+
+    prefix_ctx.set(alert_prefix)
+    file_name_ctx.set(alert_prefix[0])
+    renotify_ctx.set(check.renotify)
+    if_in_a_row_ctx.set(check.if_in_a_row)
+    batch_prefixes_ctx.set(check.batch)
+    if workers.parent_writer:
+        forwarded_calls_ctx.set([])
+
+    stats_key = (alert_prefix[0], alert_prefix[1], None)
+    checks_queued[stats_key] += 1
+    queued = True
+    finished = failed = False
+    outcome = "success"
+    start_time = duration = None  # no duration if the check hasn't started
+    steps = None
+
+    try:
+        async with AsyncExitStack() as limits:
+            for limit in check.limits:
+                await limits.enter_async_context(limit)
+
+            checks_queued[stats_key] -= 1
+            checks_in_flight[stats_key] += 1
+            queued = False
 
             alerts_precheck_hook(args_str=str(args))
             metrics_precheck_hook(args_str=str(args))
-            await asyncio.wait_for(check_func(*args), timeout=timeout)
+            start_time = time.perf_counter()
+            if check.executor:
+                steps = TimedSteps(run_in_executor(check.executor, check.func, args))
+            else:
+                steps = TimedSteps(check.func(*args))
+            await asyncio.wait_for(steps, timeout=check.timeout)
+            duration = time.perf_counter() - start_time
+            if alerts_fired():
+                outcome = "alert"
+            alert_if_blocking(steps, alert_prefix)
             metrics_postcheck_hook()
             alerts_postcheck_hook()
-        except Exception as e:
-            traceback.print_exception(e)
+            finished = True
+    except Exception as e:
+        traceback.print_exception(e)
+        if start_time is not None:
+            duration = time.perf_counter() - start_time
+
+        e_name = type(e).__name__
+        filename, funcname, parameter = alert_prefix
+        if e_name == "Exception":
+            if not str(e):
+                # skip alerts about Exception(), this is a special exception
+                if alerts_fired():
+                    outcome = "alert"
+                alert_if_blocking(steps, alert_prefix)
+                return
+            e_name = ""
+
+        outcome = "exception"
+        msg = f"проверка упала с ошибкой {e_name} {str(e)}:{filename}, функция {funcname}"
+        if isinstance(e, asyncio.TimeoutError):
+            outcome = "timeout"
+            msg = f"таймаут {filename}:{funcname}"
+
+        if check.batch is not None:
+            # no arg of the batch is checked
+            for arg in check.batch:
+                alert(f"{msg}({arg})", "__exception__", arg=arg)
+        elif parameter is not None:
+            alert(f"{msg}({parameter})", "__exception__")
+        else:
+            alert(msg, "__exception__")
+        alert_if_blocking(steps, alert_prefix)
+
+        exceptions_cnt[prefix_to_str(alert_prefix)] += 1
+        failed = True
+    finally:
+        counter = checks_queued if queued else checks_in_flight
+        counter[stats_key] -= 1
+        if check.cancelled and not counter[stats_key]:
+            del counter[stats_key]
+
+        check.task = None
+        if not check.cancelled:
+            blocking = (steps.blocked, steps.longest) if steps else None
+            interval = adapt_interval(check, outcome)
+            # first, so a failed send to the parent doesn't stop the check
+            scheduler.add(check, next_due_time(check, asyncio.get_running_loop().time()))
+
+            if workers.parent_writer:
+                try:
+                    send_to_parent(("check", {
+                        "prefix": alert_prefix, "batch": check.batch and list(check.batch),
+                        "renotify": check.renotify,
+                        "if_in_a_row": check.if_in_a_row, "calls": forwarded_calls_ctx.get(),
+                        "finished": finished, "failed": failed,
+                        "lag": schedule_lag.get(alert_prefix, 0),
+                        "duration": duration, "outcome": outcome, "blocking": blocking,
+                        "interval": interval
+                    }))
+                    await drain_parent()
+                except Exception:
+                    log(f"failed to send the results of {prefix_to_str(alert_prefix)} to the parent")
+                    traceback.print_exc()
+                    exceptions_cnt["core"] += 1
+            if duration is not None:
+                observe_check(alert_prefix, duration, outcome)
+            if blocking:
+                observe_blocking(alert_prefix, *blocking)
+            if interval is not None:
+                observe_interval(alert_prefix, interval)
+            for prefix in check.prefixes():
+                if prefix in prefix_to_checks_cnt:
+                    # the check could be unloaded while running
+                    prefix_to_checks_cnt[prefix] += 1
+                mark_dirty(prefix)
+
+
+async def run_in_executor(executor, func, args):
+    """ runs the sync checker in the pool, its alerts and metrics are replayed on the loop """
+    calls = []
+    try:
+        if executor == "thread":
+            await run_in_thread(func, args, calls)
+        else:
+            await run_in_process(func, args, calls)
+    finally:
+        replay_calls(calls)
 
-            e_name = type(e).__name__
-            filename, funcname, parameter = alert_prefix
-            if e_name == "Exception":
-                if not str(e):
-                    # skip alerts about Exception(), this is a special exception
-                    continue
-                e_name = ""
 
-            msg = f"проверка упала с ошибкой {e_name} {str(e)}:{filename}, функция {funcname}"
-            if isinstance(e, TimeoutError):
-                msg = f"таймаут {filename}:{funcname}"
+def first_due_time(check, cur_time):
+    if not check.fixed_rate or not check.pause:
+        return reserve_run_slot("start_check", 25, cur_time)
 
-            if parameter is not None:
-                msg += f"({parameter})"
+    # a stable phase inside the pause window spreads the load and survives reloads
+    phase = zlib.crc32(prefix_to_str(check.prefix).encode()) / 2**32 * check.pause
+    wall_time = time.time()
+    due_wall_time = wall_time + (phase - wall_time) % check.pause
+    return cur_time + due_wall_time - wall_time
 
-            alert(msg, "__exception__")
 
-            exceptions_cnt[prefix_to_str(alert_prefix)] += 1
-        finally:
-            prefix_to_checks_cnt[alert_prefix] += 1
+def adapt_interval(check, outcome):
+    """ updates the pause of the adaptive check by the run outcome, returns the new pause """
+    if not check.is_adaptive():
+        return None
 
-            await asyncio.sleep(pause)
+    if outcome == "success":
+        check.failures = 0
+        # healthy checks run more and more rarely
+        check.interval = min(check.max_pause, max(check.interval, check.pause) * PAUSE_GROWTH)
+    else:
+        check.failures += 1
+        # alert calls can override if_in_a_row of the checker, exceptions use the checker's
+        if_in_a_row = fired_alerts_threshold() or check.if_in_a_row
+        if check.failures < if_in_a_row:
+            # the alert is not confirmed yet, confirm or drop it sooner
+            check.interval = max(check.min_pause, min(check.interval, check.pause) / 2)
+        else:
+            check.interval = check.pause
+    return check.interval
+
+
+def next_due_time(check, cur_time):
+    pause = check.interval
+    if not check.fixed_rate or not pause:
+        return cur_time + pause
+
+    due_time = check.due_time + pause
+    if due_time < cur_time:
+        # the run took longer than pause, skip the missed runs
+        due_time += math.ceil((cur_time - due_time) / pause) * pause
+    return due_time
+
+
+def get_limits(filename, funcname, max_concurrency):
+    limits = []
+    if max_concurrency:
+        if funcname not in func_to_limit[filename]:
+            func_to_limit[filename][funcname] = asyncio.Semaphore(max_concurrency)
+        limits.append(func_to_limit[filename][funcname])
+
+    # the order matters: a stuck checker should not hold the slots of its file
+    # and a stuck file should not hold the global slots
+    if MAX_CONCURRENT_CHECKS_PER_FILE:
+        if filename not in filename_to_limit:
+            filename_to_limit[filename] = asyncio.Semaphore(MAX_CONCURRENT_CHECKS_PER_FILE)
+        limits.append(filename_to_limit[filename])
+
+    if global_limit:
+        limits.append(global_limit)
+    return limits
+
+
+def reg_checker(checker, subj, pause, renotify, max_starts_per_sec, timeout, if_in_a_row,
+                fixed_rate, max_concurrency, executor=None, min_pause=None, max_pause=None,
+                batch_idx=None):
+    pending_checkers = pending_checkers_ctx.get()
+    if pending_checkers is not None:
+        # the module is loading in a thread, register on the loop later
+        pending_checkers.append((checker, subj, pause, renotify, max_starts_per_sec, timeout,
+                                 if_in_a_row, fixed_rate, max_concurrency, executor, min_pause,
+                                 max_pause, batch_idx))
+        return
 
+    filename = file_name_ctx.get()
 
-def reg_checker(checker, subj, pause, renotify, max_starts_per_sec, timeout, if_in_a_row):
-    if subj is None:
+    batch = None
+    if batch_idx is not None:
+        # subj is the tuple of args, every arg has its own prefix for alerts and metrics
+        args = [list(subj)]
+        batch = {}
+        for arg in subj:
+            batch[arg] = (filename, checker.__name__, arg)
+            register_prefix(batch[arg])
+            mark_dirty(batch[arg])
+        alert_prefix = (filename, checker.__name__, f"__batch{batch_idx}__")
+    elif subj is None:
         args = []
+        alert_prefix = (filename, checker.__name__, subj)
     else:
         args = [subj]
+        alert_prefix = (filename, checker.__name__, subj)
+
+    register_prefix(alert_prefix)
+    mark_dirty(alert_prefix)
+
+    check = Check(checker, args, pause, prefix=alert_prefix, renotify=renotify,
+                  max_starts_per_sec=max_starts_per_sec, timeout=timeout,
+                  if_in_a_row=if_in_a_row, fixed_rate=fixed_rate,
+                  limits=get_limits(filename, checker.__name__, max_concurrency),
+                  params=(pause, renotify, max_starts_per_sec, timeout, if_in_a_row, fixed_rate,
+                          max_concurrency, executor, min_pause, max_pause, batch_idx),
+                  batch=batch, executor=executor, min_pause=min_pause, max_pause=max_pause)
+
+    scheduler.add(check, first_due_time(check, asyncio.get_running_loop().time()))
+
+    filename_to_tasks[filename].append(check)
+
+
+def split_args(args, batch_size):
+    """ returns (subj, batch_idx) of every check of the args, batch checks get tuples of up to
+        batch_size args """
+    if batch_size:
+        return [(tuple(args[i:i+batch_size]), i // batch_size)
+                for i in range(0, len(args), batch_size)]
+    return [(arg, None) for arg in args]
+
+
+async def get_source_args(args_source):
+    """ calls the args source, sync sources are called in a thread """
+    if inspect.iscoroutinefunction(args_source):
+        return list(await args_source())
+    return list(await asyncio.to_thread(args_source))
+
+
+class ArgsSource:
+    """ A function returning the args of a checker. It is called every refresh seconds and
+        only the checks of added and removed args are started and stopped """
+    def __init__(self, checker, func, refresh, batch_size, kwargs):
+        self.checker = checker
+        self.func = func
+        self.refresh = refresh
+        self.batch_size = batch_size
+        self.kwargs = kwargs
+        self.prefix = (file_name_ctx.get(), checker.__name__, "__args__")
+        self.args = []  # the last args got from the source
+        self.task = None
+
+    def make_checkers(self, args):
+        """ returns the registrations of the checks of the args, as reg_checker makes them """
+        pending_checkers = []
+        token = pending_checkers_ctx.set(pending_checkers)
+        try:
+            for subj, batch_idx in split_args(args, self.batch_size):
+                reg_checker(self.checker, subj=subj, **self.kwargs, batch_idx=batch_idx)
+        finally:
+            pending_checkers_ctx.reset(token)
+        return pending_checkers
 
-    filename = file_name_ctx.get()
+    async def call(self):
+        prefix_ctx.set(self.prefix)
+        renotify_ctx.set(self.kwargs["renotify"])
+        if_in_a_row_ctx.set(1)
+        forwarded_calls_ctx.set([] if workers.parent_writer else None)
+        alerts_precheck_hook(args_str="")
+
+        try:
+            args = await asyncio.wait_for(get_source_args(self.func), ARGS_SOURCE_TIMEOUT)
+            if not args and not self.args:
+                # nothing would be checked at all
+                raise ValueError("источник не вернул ни одного аргумента")
+            self.args = args
+        except Exception as e:
+            # the checks of the previous args keep running
+            traceback.print_exc()
+            filename, funcname, _ = self.prefix
+            alert(f"не удалось получить аргументы {filename}:{funcname}: "
+                  f"{type(e).__name__} {str(e)}", "__args__")
+        alerts_postcheck_hook()
+
+        if workers.parent_writer:
+            send_to_parent(("check", {
+                "prefix": self.prefix, "batch": None, "renotify": self.kwargs["renotify"],
+                "if_in_a_row": 1, "calls": forwarded_calls_ctx.get(),
+                "finished": True, "failed": False, "lag": None,
+                "duration": None, "outcome": None, "blocking": None, "interval": None
+            }))
+            await drain_parent()
+        elif self.prefix in prefix_to_checks_cnt:
+            prefix_to_checks_cnt[self.prefix] += 1
+            mark_dirty(self.prefix)
+        return self.args
+
+    async def get_args(self):
+        """ returns the current args, if the source fails, the previous ones """
+        # in a separate task, so the context of the caller is not changed
+        return await asyncio.create_task(self.call())
+
+    async def refresh_loop(self):
+        """ the file is loaded with the previous args, the first call is right after the load """
+        filename, funcname, _ = self.prefix
+        forwarded_calls_ctx.set(None)
+
+        while True:
+            try:
+                prev_args = self.args
+                args = await self.get_args()
+                if args != prev_args:
+                    update_checkers(filename, self.make_checkers(args), funcname)
+                    if workers.parent_writer:
+                        send_to_parent(("updated", filename, file_prefixes(filename)))
+                    else:
+                        recover_alerts(filename, unregistered_only=True)
+            except Exception:
+                traceback.print_exc()
+                exceptions_cnt["core"] += 1
+            await asyncio.sleep(self.refresh if self.args else min(self.refresh, ARGS_RETRY_PAUSE))
 
-    alert_prefix = (filename, checker.__name__, subj)
-    prefix_to_checks_cnt[alert_prefix] = 0
 
-    checkloop = run_checkloop(checker, args, pause, alert_prefix=alert_prefix,
-                              renotify=renotify,
-                              max_starts_per_sec=max_starts_per_sec,
-                              timeout=timeout, if_in_a_row=if_in_a_row)
+def start_sources(filename, sources):
+    """ starts refreshing the args of the loaded file, the sources of the previous load are
+        stopped and their args are used if the new sources fail """
+    old_sources = {source.prefix: source for source in filename_to_sources.get(filename, [])}
+    stop_sources(filename)
 
-    task = asyncio.create_task(checkloop)
+    for source in sources:
+        if source.prefix in old_sources:
+            source.args = old_sources[source.prefix].args
+        if source.prefix not in prefix_to_checks_cnt:
+            register_prefix(source.prefix)
+        source.task = asyncio.create_task(source.refresh_loop())
 
-    filename_to_tasks[filename].append(task)
+    if sources:
+        filename_to_sources[filename] = sources
+
+
+def stop_sources(filename):
+    for source in filename_to_sources.pop(filename, []):
+        source.task.cancel()
+
+
+def source_funcnames(prefixes):
+    """ the checkers with args sources, their alerts are recovered after the args are got """
+    return {prefix[1] for prefix in prefixes if prefix[2] == "__args__"}
+
+
+def file_prefixes(filename):
+    """ the prefixes of the checks and the args sources of the file """
+    prefixes = [prefix for check in filename_to_tasks.get(filename, [])
+                for prefix in check.prefixes()]
+    prefixes.extend(source.prefix for source in filename_to_sources.get(filename, []))
+    return prefixes
+
+
+async def dry_run(f, *args):
+    # sync checkers with an executor are just called
+    result = f(*args)
+    if inspect.isawaitable(result):
+        await result
 
 
 def checker(*, pause, timeout=None, args=[], renotify=float("inf"),
-            max_starts_per_sec=0, if_in_a_row=1):
+            max_starts_per_sec=0, if_in_a_row=1, fixed_rate=False, max_concurrency=0,
+            batch_size=0, args_refresh=300, executor=None, min_pause=None, max_pause=None):
+    """ registers the checker function. The args can be a list or a function returning it,
+        the function is called every args_refresh seconds. Batch checkers get lists of up to
+        batch_size args. Sync checkers are run in the "thread" or "process" executor.
+        With min_pause or max_pause the pause is shortened while an alert is not confirmed
+        and is lengthened while the check is healthy """
+    if executor is not None and executor not in EXECUTORS:
+        raise ValueError(f"executor should be one of {EXECUTORS}, not {executor!r}")
+    if ((min_pause is not None and min_pause > pause) or
+            (max_pause is not None and max_pause < pause)):
+        raise ValueError("the pause should be between min_pause and max_pause")
+
+    def check_func(f):
+        # the coroutine of an async checker would be never awaited in the executor
+        if executor is not None and inspect.iscoroutinefunction(f):
+            raise ValueError(f"{f.__name__} is async, executor is only for sync checkers")
+
     if not file_name_ctx.get():
         # if script runs directly, execute immidiately
         def new_f(f):
-            if not args:
-                print(f"Dry running {f.__name__}():")
-                asyncio.run(f())
-            else:
-                async def dry_runner():
-                    for arg in args:
-                        print(f"Dry running {f.__name__}({arg!r}):")
-                        await f(arg)
+            check_func(f)
+
+            async def dry_runner():
+                checker_args = await get_source_args(args) if callable(args) else args
+                if not checker_args and not callable(args):
+                    print(f"Dry running {f.__name__}():")
+                    await dry_run(f)
+
+                for subj, batch_idx in split_args(checker_args, batch_size):
+                    if batch_idx is not None:
+                        subj = list(subj)
+                    print(f"Dry running {f.__name__}({subj!r}):")
+                    await dry_run(f, subj)
 
-                asyncio.run(dry_runner())
+            asyncio.run(dry_runner())
         return new_f
 
     kwargs = {
@@ -131,51 +674,215 @@ def checker(*, pause, timeout=None, args=[], renotify=float("inf"),
         "renotify": renotify,
         "max_starts_per_sec": max_starts_per_sec,
         "timeout": timeout,
-        "if_in_a_row": if_in_a_row
+        "if_in_a_row": if_in_a_row,
+        "fixed_rate": fixed_rate,
+        "max_concurrency": max_concurrency,
+        "executor": executor,
+        "min_pause": min_pause,
+        "max_pause": max_pause
     }
 
     def decorator(f):
-        if not args:
+        check_func(f)
+        if callable(args):
+            # the source is called on the loop after the module is loaded
+            pending_sources_ctx.get().append(ArgsSource(f, args, args_refresh, batch_size, kwargs))
+        elif not args:
             reg_checker(f, subj=None, **kwargs)
         else:
-            for arg in args:
-                reg_checker(f, subj=arg, **kwargs)
+            for subj, batch_idx in split_args(args, batch_size):
+                reg_checker(f, subj=subj, **kwargs, batch_idx=batch_idx)
         return f
 
     return decorator
 
 
-def reset_checks_cnt(filename):
+def reset_checks_cnt(filename, keep=frozenset()):
     global prefix_to_checks_cnt
-    for p in list(prefix_to_checks_cnt):
-        if p[0] == filename:
-            del prefix_to_checks_cnt[p]
+    prefixes = filename_to_prefixes.pop(filename, set())
+    kept_funcnames = {p[1] for p in prefixes & keep}
+    for p in prefixes - keep:
+        del prefix_to_checks_cnt[p]
+        forget_check(p)
+        if p[1] not in kept_funcnames:
+            forget_checker(filename, p[1])
+
+    if prefixes & keep:
+        filename_to_prefixes[filename] = prefixes & keep
+
+
+def exec_module(module, loop):
+    """ runs in a thread, module-level code can get the loop with asyncio.get_event_loop() """
+    asyncio.set_event_loop(loop)
+    try:
+        module.__spec__.loader.exec_module(module)
+    finally:
+        asyncio.set_event_loop(None)
+
+
+def replay_loading_calls(calls):
+    forwarded_calls_ctx.set(None)
+    replay_calls(calls)
+    calls.clear()
+
+
+def code_signature(code):
+    """ the code without line numbers, so checkers are not restarted when lines move """
+    consts = tuple(code_signature(c) if isinstance(c, types.CodeType) else c
+                   for c in code.co_consts)
+    return (code.co_code, consts, code.co_names, code.co_varnames, code.co_freevars,
+            code.co_cellvars, code.co_argcount, code.co_kwonlyargcount, code.co_flags)
+
+
+def update_checkers(filename, pending_checkers, funcname=None):
+    """ starts new and changed checkers of the loaded file and stops removed and changed ones,
+        the unchanged checks keep their schedule and only get the new function.
+        If funcname is given, only the checks of this checker function are updated """
+    old_checks = defaultdict(list)
+    other_checks = []
+    for check in filename_to_tasks.pop(filename, []):
+        if funcname is not None and check.prefix[1] != funcname:
+            other_checks.append(check)
+            continue
+        # the subj of a batch check is the tuple of its args
+        subj = check.prefix[2] if check.batch is None else tuple(check.args[0])
+        old_checks[(check.prefix[1], subj)].append(check)
+
+    signatures = {}
+    def get_signature(func):
+        if func.__code__ not in signatures:
+            signatures[func.__code__] = code_signature(func.__code__)
+        return signatures[func.__code__]
+
+    kept = []
+    new_checkers = []
+    for checker_args in pending_checkers:
+        func, subj, *params = checker_args
+        same_checks = old_checks.get((func.__name__, subj))
+        if (same_checks and same_checks[0].params == tuple(params) and
+                get_signature(same_checks[0].func) == get_signature(func)):
+            check = same_checks.pop(0)
+            check.func = func
+            kept.append(check)
+        else:
+            new_checkers.append(checker_args)
+
+    removed = [check for checks in old_checks.values() for check in checks]
+    scheduler.forget(removed)
+    for check in removed:
+        check.cancel()
+
+    # changed checkers get new concurrency limits
+    kept_funcnames = {check.prefix[1] for check in kept}
+    removed_funcnames = {check.prefix[1] for check in removed} - kept_funcnames
+    for removed_funcname in removed_funcnames:
+        func_to_limit[filename].pop(removed_funcname, None)
+    forget_check_stats(filename, removed_funcnames)
+
+    if kept or funcname is not None:
+        log(f"{filename}: {len(kept)} checks kept, {len(new_checkers)} started, "
+            f"{len(removed)} stopped")
+
+    filename_to_tasks[filename] = other_checks + kept
+    reset_checks_cnt(filename, keep=set(file_prefixes(filename)))
+    for checker_args in new_checkers:
+        reg_checker(*checker_args)
 
 
 async def reg_checker_module(filename, full_filename):
     global prefix_to_checks_cnt
 
     file_name_ctx.set(filename)
-    reset_checks_cnt(filename)
     prefix_ctx.set((filename, "__loading__", None))
 
+    # the module is read, compiled and executed in a thread, checkers are registered and
+    # module-level alerts and metrics are replayed on the loop
+    pending_checkers = []
+    pending_checkers_ctx.set(pending_checkers)
+    pending_sources = []
+    pending_sources_ctx.set(pending_sources)
+    calls = []
+    forwarded_calls_ctx.set(calls)
+
+    start_time = time.perf_counter()
+    thread_time = 0
+    module = None
+    error = None
     try:
         spec = importlib.util.spec_from_file_location(filename, full_filename)
         module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
-        recover_alerts(filename, unregistered_only=True)
-        return module
+
+        thread_start_time = time.perf_counter()
+        try:
+            await asyncio.to_thread(exec_module, module, asyncio.get_running_loop())
+        except RuntimeError as E:
+            if "no running event loop" not in str(E):
+                raise
+            log(f"{filename} needs the running loop at import, loading it on the loop")
+            pending_checkers.clear()
+            pending_sources.clear()
+            calls.clear()
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        finally:
+            thread_time = time.perf_counter() - thread_start_time
     except Exception as E:
         traceback.print_exc()
-        alert(f"Failed to load {filename}: {str(E)}")
+        module = None
+        error = E
+
+    pending_checkers_ctx.set(None)
+    pending_sources_ctx.set(None)
+    try:
+        # the checks of the args sources start with the previous args, the sources refresh
+        # them in their own tasks, so slow sources don't delay the load
+        start_sources(filename, pending_sources)
+        for source in pending_sources:
+            pending_checkers.extend(source.make_checkers(source.args))
+
+        # if the module has failed, the checkers registered before the failure are kept
+        update_checkers(filename, pending_checkers)
+
+        if error is None:
+            if not workers.parent_writer:
+                replay_loading_calls(calls)
+            recover_alerts(filename, unregistered_only=True,
+                           keep_funcnames=source_funcnames(file_prefixes(filename)))
+        else:
+            alert(f"Failed to load {filename}: {str(error)}")
+    finally:
+        duration = time.perf_counter() - start_time
+        stall = duration - thread_time
+        observe_reload(filename, stall, duration)
+
+        if workers.parent_writer:
+            send_to_parent(("loaded", filename, file_prefixes(filename), calls, error is None,
+                            stall, duration))
+        else:
+            replay_loading_calls(calls)
+    return module
+
+
+def forget_check_stats(filename, funcnames):
+    # the cancelled checks which are still running delete their keys when they finish
+    for funcname in funcnames:
+        stats_key = (filename, funcname, None)
+        for counter in (checks_in_flight, checks_queued):
+            if not counter.get(stats_key):
+                counter.pop(stats_key, None)
 
 
 def cancel_task(filename):
-    for task in filename_to_tasks[filename]:
-        task.cancel()
+    checks = filename_to_tasks.pop(filename, [])
+    scheduler.forget(checks)
+    for check in checks:
+        check.cancel()
+    forget_check_stats(filename, {check.prefix[1] for check in checks})
+    stop_sources(filename)
 
-    filename_to_tasks.pop(filename, None)
-    gc.collect()
+    filename_to_limit.pop(filename, None)
+    func_to_limit.pop(filename, None)
+    # the caller should gc.collect() once after cancelling all reloaded files
 
 class SurviveReloadsVar:
     def __init__(self, name, obj):
@@ -184,6 +891,7 @@ class SurviveReloadsVar:
 
         if self.k not in reload_survivers:
             reload_survivers[self.k] = obj
+            filename_to_survivor_names[self.k[0]].add(name)
 
     def get(self):
         global reload_survivers
@@ -193,15 +901,166 @@ class SurviveReloadsVar:
     def set(self, obj):
         global reload_survivers
         reload_survivers[self.k] = obj
+        filename_to_survivor_names[self.k[0]].add(self.k[1])
 
 def clean_survivers(filename):
     global reload_survivers
-    for f, obj in list(reload_survivers):
-        if f == filename and (f, obj) in reload_survivers:
-            del reload_survivers[(f, obj)]
+    for name in filename_to_survivor_names.pop(filename, ()):
+        reload_survivers.pop((filename, name), None)
+
+
+def replay_calls(calls):
+    funcs = {"alert": alert, "metric": metric}
+    for func_name, args, kwargs in calls:
+        funcs[func_name](*args, **kwargs)
+
+
+def replay_check(run):
+    prefix = run["prefix"]
+
+    prefix_ctx.set(prefix)
+    file_name_ctx.set(prefix[0])
+    renotify_ctx.set(run["renotify"])
+    if_in_a_row_ctx.set(run["if_in_a_row"])
+    if run["batch"] is not None:
+        batch_prefixes_ctx.set({arg: (prefix[0], prefix[1], arg) for arg in run["batch"]})
+
+    alerts_precheck_hook(args_str="")
+    metrics_precheck_hook(args_str="")
+    replay_calls(run["calls"])
+    if run["finished"]:
+        metrics_postcheck_hook()
+        alerts_postcheck_hook()
+
+    if run["failed"]:
+        exceptions_cnt[prefix_to_str(prefix)] += 1
+    if run["lag"] is not None:
+        schedule_lag[prefix] = run["lag"]
+    if run["duration"] is not None:
+        observe_check(prefix, run["duration"], run["outcome"])
+    if run["blocking"]:
+        observe_blocking(prefix, *run["blocking"])
+    if run["interval"] is not None:
+        observe_interval(prefix, run["interval"])
+    for checked_prefix in checked_prefixes():
+        if checked_prefix in prefix_to_checks_cnt:
+            prefix_to_checks_cnt[checked_prefix] += 1
+        mark_dirty(checked_prefix)
+
+
+def replay_prefixes(filename, prefixes):
+    # the counters of the checks kept by the worker are kept too
+    reset_checks_cnt(filename, keep=set(prefixes))
+    for prefix in prefixes:
+        if prefix not in prefix_to_checks_cnt:
+            register_prefix(prefix)
+            mark_dirty(prefix)
+
+
+def replay_load(filename, prefixes, calls, loaded, stall, duration):
+    file_name_ctx.set(filename)
+    prefix_ctx.set((filename, "__loading__", None))
+
+    replay_prefixes(filename, prefixes)
+    replay_calls(calls)
+    if loaded:
+        recover_alerts(filename, unregistered_only=True, keep_funcnames=source_funcnames(prefixes))
+    observe_reload(filename, stall, duration)
+
+
+# the counters which are collected in workers and exported by the main process
+WORKER_STATS = (checks_in_flight, checks_queued, http_requests, http_connects, active_tasks)
+
+
+def replace_worker_stats(old_stats, new_stats):
+    for counter, old, new in zip(WORKER_STATS, old_stats, new_stats):
+        for key in old:
+            counter.pop(key, None)
+        counter.update(new)
+
+
+async def supervise_worker(directory, worker_idx, workers_cnt):
+    WORKER_RESTART_PAUSE = 5
+
+    while True:
+        filenames = set()
+        stats = [{} for counter in WORKER_STATS]
+        proc = writer = None
+        try:
+            proc, reader, writer = await spawn_worker(directory, worker_idx, workers_cnt)
+            log(f"worker {worker_idx} started, pid {proc.pid}")
+
+            while (msg := await read_msg(reader)) is not None:
+                if msg[0] == "check":
+                    contextvars.copy_context().run(replay_check, msg[1])
+                elif msg[0] == "loaded":
+                    filenames.add(msg[1])
+                    contextvars.copy_context().run(replay_load, *msg[1:])
+                elif msg[0] == "updated":
+                    # the args of some checker are changed
+                    replay_prefixes(msg[1], msg[2])
+                    recover_alerts(msg[1], unregistered_only=True)
+                elif msg[0] == "unloaded":
+                    filenames.discard(msg[1])
+                    recover_alerts(msg[1])
+                    reset_checks_cnt(msg[1])
+                    forget_reload(msg[1])
+                elif msg[0] == "stats":
+                    replace_worker_stats(stats, msg[1])
+                    stats = msg[1]
+                    loop_lag[f"worker{worker_idx}"] = msg[2]
+        except Exception:
+            traceback.print_exc()
+            exceptions_cnt["core"] += 1
+        finally:
+            if writer:
+                writer.close()
+            if proc:
+                if proc.returncode is None:
+                    proc.kill()
+                await proc.wait()
+
+        log(f"worker {worker_idx} exited, restarting")
+
+        # the alerts of the worker's files should not be sent until the files are reloaded
+        for filename in filenames:
+            reset_checks_cnt(filename)
+        replace_worker_stats(stats, [{} for counter in WORKER_STATS])
+        loop_lag.pop(f"worker{worker_idx}", None)
 
+        await asyncio.sleep(WORKER_RESTART_PAUSE)
 
-async def run(directory="."):
+
+async def worker_stats_loop():
+    STATS_PAUSE = 5
+    while True:
+        active_tasks.clear()
+        active_tasks.update({filename: len(tasks) for filename, tasks in filename_to_tasks.items()})
+        send_to_parent(("stats", [dict(counter) for counter in WORKER_STATS],
+                        loop_lag.get("main", 0)))
+        await drain_parent()
+        await asyncio.sleep(STATS_PAUSE)
+
+
+def worker_main(directory, worker_idx, workers_cnt, fd):
+    async def run_worker():
+        file_name_ctx.set("asmon.py")
+        prefix_ctx.set(("asmon.py", "core", None))
+
+        reader = await connect_to_parent(fd)
+
+        check_scheduler = asyncio.create_task(scheduler.loop())
+        stats_sender = asyncio.create_task(worker_stats_loop())
+        lag_monitor = asyncio.create_task(loop_lag_loop())
+        checks_loader = asyncio.create_task(run_checks(directory, (worker_idx, workers_cnt)))
+
+        # exit with the main process
+        await reader.read()
+
+    asyncio.run(run_worker())
+
+
+async def run(directory=".", workers=0):
     file_name_ctx.set("asmon.py")
     prefix_ctx.set(("asmon.py", "core", None))
     
@@ -219,15 +1078,48 @@ async def run(directory="."):
     stat_printer = asyncio.create_task(alert_stats_loop())
     alert_saver = asyncio.create_task(alert_save_loop())
     metrics_handler = asyncio.create_task(start_metrics_srv())
+    lag_monitor = asyncio.create_task(loop_lag_loop())
+
+    if workers:
+        # check files are sharded between worker processes, this process
+        # keeps alerts, sends them and exports metrics
+        await asyncio.gather(*[supervise_worker(directory, worker_idx, workers)
+                               for worker_idx in range(workers)])
+        return
+
+    check_scheduler = asyncio.create_task(scheduler.loop())
+    await run_checks(directory)
+
+
+def is_checker_filename(filename, shard=None):
+    if not re.fullmatch(r"check_\S+\.py", filename):
+        return False
+    return not shard or in_shard(filename, *shard)
 
+
+async def run_checks(directory, shard=None):
     filename_to_mod_time = {}
 
     PAUSE_RESCANS = 5
+    # with inotify the directory is rescanned only in case some events were lost
+    PAUSE_FULL_RESCANS = 60
+
+    watcher = watch_directory(directory, lambda f: is_checker_filename(f, shard))
+    changed_filenames = None  # None means all files
 
     iter_num = 0
     while True:
         iter_num += 1
-        checker_filenames = [f for f in os.listdir(directory) if re.fullmatch(r"check_\S+\.py", f)]
+        if changed_filenames is None:
+            checker_filenames = [f for f in os.listdir(directory) if is_checker_filename(f, shard)]
+            deleted_filenames = set(filename_to_tasks) - set(checker_filenames)
+        else:
+            checker_filenames = [f for f in changed_filenames
+                                 if os.path.exists(os.path.join(directory, f))]
+            deleted_filenames = (changed_filenames & set(filename_to_tasks)) - set(checker_filenames)
+
+        # the garbage of all reloaded and deleted files is collected once
+        filenames_to_load = []
         for filename in checker_filenames:
             try:
                 full_filename = os.path.join(directory, filename)
@@ -241,28 +1133,45 @@ async def run(directory="."):
                     else:
                         log("file", filename, "changed, reloading")
 
-                    cancel_task(filename)
-
                     filename_to_mod_time.pop(filename, None)
-
-                    module = await asyncio.create_task(reg_checker_module(filename, full_filename))
-                    filename_to_mod_time[filename] = mod_time
+                    filenames_to_load.append((filename, mod_time))
             except Exception:
                 log(f"failed to load {filename}")
                 traceback.print_exc()
                 exceptions_cnt["core"] += 1
 
-        for filename in set(filename_to_tasks) - set(checker_filenames):
+        for filename in deleted_filenames:
             try:
                 log("file", filename, "deleted, unloading")
                 cancel_task(filename)
                 recover_alerts(filename)
+                reset_checks_cnt(filename)
                 clean_survivers(filename)
+                close_clients(filename)
                 filename_to_mod_time.pop(filename, None)
+                forget_reload(filename)
+                if workers.parent_writer:
+                    send_to_parent(("unloaded", filename))
             except Exception:
                 log(f"failed to unload {filename}")
                 traceback.print_exc()
                 exceptions_cnt["core"] += 1
 
-        await asyncio.sleep(PAUSE_RESCANS)
+        for filename, mod_time in filenames_to_load:
+            try:
+                full_filename = os.path.join(directory, filename)
+                module = await asyncio.create_task(reg_checker_module(filename, full_filename))
+                filename_to_mod_time[filename] = mod_time
+            except Exception:
+                log(f"failed to load {filename}")
+                traceback.print_exc()
+                exceptions_cnt["core"] += 1
+
+        if filenames_to_load or deleted_filenames:
+            gc.collect()
+
+        if watcher:
+            changed_filenames = await watcher.wait_changes(PAUSE_FULL_RESCANS)
+        else:
+            await asyncio.sleep(PAUSE_RESCANS)
 
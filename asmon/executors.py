@@ -0,0 +1,107 @@
+# thread and process pools to run sync checkers, see executor in checker
+import asyncio
+import concurrent.futures
+import contextvars
+import importlib.util
+import multiprocessing
+import os
+import traceback
+
+from config import EXECUTOR_THREADS, EXECUTOR_PROCESSES
+
+from .commons import (file_name_ctx, prefix_ctx, renotify_ctx, if_in_a_row_ctx,
+                      batch_prefixes_ctx, forwarded_calls_ctx)
+from .alerts import alerts_precheck_hook
+from .metrics import metrics_precheck_hook
+
+EXECUTORS = ("thread", "process")
+
+# the pools are shared by all checkers and created on the first use
+thread_pool = None
+process_pool = None
+
+# in pool processes, full filename => (mod time, module)
+loaded_modules = {}
+
+
+async def run_in_thread(func, args, calls):
+    """ runs the sync checker in the thread pool, its alert and metric calls are added to calls """
+    global thread_pool
+    if thread_pool is None:
+        thread_pool = concurrent.futures.ThreadPoolExecutor(EXECUTOR_THREADS,
+                                                            thread_name_prefix="asmon-checker")
+
+    # the thread sees the context of the check, but doesn't change the state of the loop
+    ctx = contextvars.copy_context()
+    ctx.run(forwarded_calls_ctx.set, calls)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(thread_pool, ctx.run, func, *args)
+
+
+async def run_in_process(func, args, calls):
+    """ runs the sync checker in the process pool, its alert and metric calls are added to calls """
+    global process_pool
+    if process_pool is None:
+        # no fork, the loop and its threads should not be copied
+        process_pool = concurrent.futures.ProcessPoolExecutor(
+            EXECUTOR_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+
+    ctx_values = (file_name_ctx.get(), prefix_ctx.get(), renotify_ctx.get(),
+                  if_in_a_row_ctx.get(), batch_prefixes_ctx.get())
+    loop = asyncio.get_running_loop()
+    process_calls, error = await loop.run_in_executor(
+        process_pool, call_in_process, func.__code__.co_filename, func.__name__, args, ctx_values)
+
+    calls.extend(process_calls)
+    if error is not None:
+        raise error
+
+
+def load_module(filename, full_filename):
+    """ loads the check file in a pool process, its checkers are not registered and
+        module-level alerts and metrics are dropped """
+    from .core import pending_checkers_ctx, pending_sources_ctx
+
+    mod_time = os.path.getmtime(full_filename)
+    if full_filename in loaded_modules and loaded_modules[full_filename][0] == mod_time:
+        return loaded_modules[full_filename][1]
+
+    file_name_ctx.set(filename)
+    prefix_ctx.set((filename, "__loading__", None))
+    pending_checkers_ctx.set([])
+    pending_sources_ctx.set([])
+    forwarded_calls_ctx.set([])
+
+    spec = importlib.util.spec_from_file_location(filename, full_filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    loaded_modules[full_filename] = (mod_time, module)
+    return module
+
+
+def call_in_process(full_filename, funcname, args, ctx_values):
+    """ runs in a pool process, returns the alert and metric calls and the exception """
+    def call():
+        filename, prefix, renotify, if_in_a_row, batch_prefixes = ctx_values
+        func = getattr(contextvars.copy_context().run(load_module, filename, full_filename),
+                       funcname)
+
+        file_name_ctx.set(filename)
+        prefix_ctx.set(prefix)
+        renotify_ctx.set(renotify)
+        if_in_a_row_ctx.set(if_in_a_row)
+        batch_prefixes_ctx.set(batch_prefixes)
+        forwarded_calls_ctx.set(calls)
+        alerts_precheck_hook(args_str=str(args))
+        metrics_precheck_hook(args_str=str(args))
+        func(*args)
+
+    calls = []
+    try:
+        contextvars.copy_context().run(call)
+    except Exception as e:
+        # the traceback is lost when the exception is sent back
+        traceback.print_exc()
+        # the calls made before the exception are kept
+        return calls, e
+    return calls, None
@@ -2,17 +2,69 @@ import asyncio
 import time
 import traceback
 import contextvars
-from collections import Counter, defaultdict
+import zlib
+import bisect
+from collections import Counter, defaultdict, deque
 
 from config import METRICS_PORT, IP_WHITELIST
-from .commons import (log, prefix_to_str, prefix_to_id_to_alert, filename_to_tasks,
-                      prefix_to_checks_cnt, prefix_ctx)
+from .commons import (log, prefix_to_str, prefix_to_alerts, filename_to_tasks,
+                      prefix_to_checks_cnt, prefix_ctx, file_name_ctx, forwarded_calls_ctx,
+                      arg_to_prefix, checked_prefixes)
 
 # metrics
 tg_fails = 0
 send_alert_queue_size = 0
 exceptions_cnt = Counter({"core": 0, "alert_sender": 0})
 
+# prefix => how late the last run has started, in seconds
+schedule_lag = {}
+
+# (filename, funcname, None) => number of running and waiting for a free slot checks
+checks_in_flight = Counter()
+checks_queued = Counter()
+
+# check duration histogram buckets, in seconds
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# (filename, funcname, None) => counts of durations per bucket, then the overflow count and
+# the durations sum
+check_durations = {}
+
+# filename => requests by pooled http clients of checks and new connections opened for them
+http_requests = Counter()
+http_connects = Counter()
+
+# filename => check tasks of the files loaded by workers, the main process has filename_to_tasks
+active_tasks = Counter()
+
+# alert messages delivery, reported by send_alerts.py
+delivery_durations = [0] * (len(DURATION_BUCKETS) + 2)
+delivery_fails = Counter()  # reason => count
+delivery_retries = 0
+
+# prefix => the total time of check steps which blocked the event loop, in seconds
+blocking_time = Counter()
+
+# prefix => the longest step of the last check run, only for checks which blocked the loop
+longest_step = {}
+
+# prefix => the current pause of checks with adaptive pause
+check_intervals = {}
+
+# process name => the worst event loop lag for the last LOOP_LAG_WINDOW seconds
+loop_lag = {}
+LOOP_LAG_PAUSE = 0.5
+LOOP_LAG_WINDOW = 60
+
+# filename => how long the last reload took and how long it held the event loop, in seconds
+reload_duration = {}
+reload_stall = {}
+
+CHECK_OUTCOMES = ("success", "alert", "exception", "timeout")
+
+# (filename, funcname, None) => counts per outcome, in CHECK_OUTCOMES order
+check_outcomes = {}
+
 # prefix => {description) => value
 user_metrics = defaultdict(dict)
 
@@ -23,33 +75,214 @@ START_TIME = time.time()
 
 
 
+# per prefix metrics, their lines are rendered again only if the prefix is marked dirty
+PREFIX_METRICS = [
+    ("checks", "counter", "checks counter by prefix"),
+    ("schedule_lag_seconds", "gauge", "how late the last check run has started"),
+    ("check_interval_seconds", "gauge", "the current pause of checks with adaptive pause"),
+    ("alerts", "counter", "active alerts counter by prefix"),
+    ("check_duration_seconds", "histogram", "check duration by checker function"),
+    ("check_outcomes", "counter", "check results by checker function and outcome"),
+    ("blocking_seconds", "counter", "time the checks blocked the event loop by prefix"),
+    ("longest_step_seconds", "gauge", "the longest step of the last check run of blocking checks"),
+    ("metric", "gauge", "user metrics"),
+]
+
+# metric name => {prefix => rendered lines}, they are sent without joining them all
+prefix_lines = defaultdict(dict)
+
+dirty_prefixes = set()
+
+
+def mark_dirty(prefix):
+    dirty_prefixes.add(prefix)
+
+
 def metrics_precheck_hook(args_str):
     new_metrics_ctx.set(set())
 
 
 def metrics_postcheck_hook():
     new_metrics = new_metrics_ctx.get()
-    prefix = prefix_ctx.get()
 
     # unset old metrics
-    user_metrics[prefix] = {k: v for k, v in user_metrics[prefix].items() if k in new_metrics}
+    for prefix in checked_prefixes():
+        if prefix in user_metrics:
+            user_metrics[prefix] = {k: v for k, v in user_metrics[prefix].items()
+                                    if (prefix, k) in new_metrics}
+        mark_dirty(prefix)
+
+
+def metric(name, value, arg=None):
+    """ sets the user metric of the check, batch checks can set it for their arg """
+    if not file_name_ctx.get():
+        # if script runs directly, do nothing
+        return
 
+    prefix = prefix_ctx.get() if arg is None else arg_to_prefix(arg)
 
-def metric(name, value):
-    new_metrics_ctx.get().add(name)
-    prefix = prefix_ctx.get()
+    forwarded_calls = forwarded_calls_ctx.get()
+    if forwarded_calls is not None:
+        forwarded_calls.append(("metric", (name, value), {"arg": arg}))
+        return
+
+    new_metrics_ctx.get().add((prefix, name))
     user_metrics[prefix][name] = value
+    mark_dirty(prefix)
+
+
+def add_to_histogram(durations, duration):
+    durations[bisect.bisect_left(DURATION_BUCKETS, duration)] += 1
+    durations[-1] += duration
+
+
+def observe_delivery(duration, retries, fail_reason=None):
+    """ should be called by send_alerts for every message, fail_reason is set if it was not sent """
+    global delivery_retries
+
+    add_to_histogram(delivery_durations, duration)
+    delivery_retries += retries
+    if fail_reason:
+        delivery_fails[fail_reason] += 1
+
+
+def observe_check(prefix, duration, outcome):
+    # the checks of all args of the function share the series
+    func_key = (prefix[0], prefix[1], None)
+    if func_key not in check_durations:
+        check_durations[func_key] = [0] * (len(DURATION_BUCKETS) + 2)
+        check_outcomes[func_key] = [0] * len(CHECK_OUTCOMES)
+
+    add_to_histogram(check_durations[func_key], duration)
+
+    check_outcomes[func_key][CHECK_OUTCOMES.index(outcome)] += 1
+    mark_dirty(func_key)
+
+
+def observe_blocking(prefix, blocked, longest):
+    if not blocked and prefix not in longest_step:
+        return
+
+    blocking_time[prefix] += blocked
+    longest_step[prefix] = longest
+    mark_dirty(prefix)
+
+
+def observe_interval(prefix, interval):
+    check_intervals[prefix] = interval
+    mark_dirty(prefix)
+
+
+def forget_check(prefix):
+    schedule_lag.pop(prefix, None)
+    check_intervals.pop(prefix, None)
+    blocking_time.pop(prefix, None)
+    longest_step.pop(prefix, None)
+    mark_dirty(prefix)
+
+
+def forget_checker(filename, funcname):
+    func_key = (filename, funcname, None)
+    check_durations.pop(func_key, None)
+    check_outcomes.pop(func_key, None)
+    mark_dirty(func_key)
+
+
+def observe_reload(filename, stall, duration):
+    reload_stall[filename] = stall
+    reload_duration[filename] = duration
 
 
-def make_metrics_pkt(metrics):
-    pkt_body_list = []
+def forget_reload(filename):
+    reload_stall.pop(filename, None)
+    reload_duration.pop(filename, None)
+
+
+def escape_label(val):
+    return str(val).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+def render_histogram(name, labels, durations):
+    bucket_labels = labels + "," if labels else ""
+    labels = "{" + labels + "}" if labels else ""
+
+    lines = []
+    total = 0
+    for bound, count in zip(DURATION_BUCKETS, durations):
+        total += count
+        lines.append(f'{name}_bucket{{{bucket_labels}le="{bound}"}} {total}\n')
+    total += durations[-2]
+    lines.append(f'{name}_bucket{{{bucket_labels}le="+Inf"}} {total}\n')
+    lines.append(f'{name}_sum{labels} {durations[-1]}\n')
+    lines.append(f'{name}_count{labels} {total}\n')
+    return "".join(lines)
+
+
+def render_prefix(prefix):
+    """ returns metric name => lines of the prefix """
+    label = escape_label(prefix_to_str(prefix))
+    lines = {}
+
+    if prefix in prefix_to_checks_cnt:
+        lines["checks"] = f'asmon_checks{{prefix="{label}"}} {prefix_to_checks_cnt[prefix]}\n'
+
+    if prefix in schedule_lag:
+        lines["schedule_lag_seconds"] = f'asmon_schedule_lag_seconds{{prefix="{label}"}} {schedule_lag[prefix]}\n'
+
+    if prefix in check_intervals:
+        lines["check_interval_seconds"] = f'asmon_check_interval_seconds{{prefix="{label}"}} {check_intervals[prefix]}\n'
+
+    if prefix in prefix_to_alerts or prefix in prefix_to_checks_cnt:
+        alerts_cnt = len(prefix_to_alerts.get(prefix, ()))
+        lines["alerts"] = f'asmon_alerts{{prefix="{label}"}} {alerts_cnt}\n'
+
+    if prefix in check_durations:
+        lines["check_duration_seconds"] = render_histogram("asmon_check_duration_seconds",
+                                                           f'prefix="{label}"',
+                                                           check_durations[prefix])
+
+        lines["check_outcomes"] = "".join(
+            f'asmon_check_outcomes{{prefix="{label}",outcome="{outcome}"}} {count}\n'
+            for outcome, count in zip(CHECK_OUTCOMES, check_outcomes[prefix]))
+
+    if prefix in longest_step:
+        lines["blocking_seconds"] = f'asmon_blocking_seconds{{prefix="{label}"}} {blocking_time[prefix]}\n'
+        lines["longest_step_seconds"] = f'asmon_longest_step_seconds{{prefix="{label}"}} {longest_step[prefix]}\n'
+
+    if user_metrics.get(prefix):
+        lines["metric"] = "".join(f'asmon_metric{{prefix="{label}",name="{escape_label(name)}"}} {val}\n'
+                                  for name, val in user_metrics[prefix].items())
+    return lines
+
+
+def render_dirty_prefixes():
+    for prefix in dirty_prefixes:
+        lines = render_prefix(prefix)
+
+        for name, m_type, desc in PREFIX_METRICS:
+            if name in lines:
+                prefix_lines[name][prefix] = lines[name].encode("utf8")
+            else:
+                prefix_lines[name].pop(prefix, None)
+
+    dirty_prefixes.clear()
+
+
+def render_header(name, m_type, desc, openmetrics):
+    if openmetrics and m_type == "counter":
+        # OpenMetrics counters should have the _total suffix, ours don't always
+        m_type = "unknown"
+    return f"# HELP {name} {desc}\n# TYPE {name} {m_type}\n".encode("utf8")
+
+
+def render_metrics(metrics, openmetrics):
+    lines = []
     used_names = set()
 
     for name, m_type, desc, val in metrics:
         name = "asmon_" + name
         if name not in used_names:
-            pkt_body_list.append(f"# HELP {name} {desc}")
-            pkt_body_list.append(f"# TYPE {name} {m_type}")
+            lines.append(render_header(name, m_type, desc, openmetrics))
             used_names.add(name)
 
         if isinstance(val, dict):
@@ -57,30 +290,201 @@ def make_metrics_pkt(metrics):
             for tag, tag_val in val.items():
                 if tag == "val":
                     continue
-                tag_val = tag_val.replace('"', r'\"')
-                tags.append(f'{tag}="{tag_val}"')
-            pkt_body_list.append(f"{name}{{{','.join(tags)}}} {val['val']}")
+                tags.append(f'{tag}="{escape_label(tag_val)}"')
+            lines.append(f"{name}{{{','.join(tags)}}} {val['val']}\n".encode("utf8"))
         else:
-            pkt_body_list.append(f"{name} {val}")
-    pkt_body_bytes = ("\n".join(pkt_body_list) + "\n").encode("utf8")
-
-    # pkt_body = "\n".join(map(str,asyncio.all_tasks())) + pkt_body
+            lines.append(f"{name} {val}\n".encode("utf8"))
+    return b"".join(lines)
+
+
+def make_metrics_body(openmetrics=False):
+    """ returns the list of byte chunks, the lines of every prefix are a separate chunk,
+        so a scrape renders only the dirty prefixes """
+    metrics = []
+    metrics.append(["uptime", "counter", "asmon uptime", time.time() - START_TIME])
+    metrics.append(["tg_fails", "counter", "tg send fails", tg_fails])
+    metrics.append(["send_alert_queue_size", "gauge", "alert send queue", send_alert_queue_size])
+    metrics.append(["tasks", "gauge", "number of tasks", len(asyncio.all_tasks())])
+    metrics.append(['checks_total', "counter", "number of checks", sum(prefix_to_checks_cnt.values())])
+
+    active_alerts = sum(map(len, prefix_to_alerts.values()))
+    metrics.append(['alerts_total', "counter", "number of active alerts", active_alerts])
+
+    for prefix, count in checks_in_flight.items():
+        metrics.append(["checks_in_flight", "gauge", "running checks by checker function",
+                       {"prefix": prefix_to_str(prefix), "val": count}])
+
+    for prefix, count in checks_queued.items():
+        metrics.append(["checks_queued", "gauge",
+                        "checks waiting for a concurrency slot by checker function",
+                       {"prefix": prefix_to_str(prefix), "val": count}])
+
+    for process_name, lag in loop_lag.items():
+        metrics.append(["loop_lag_seconds", "gauge",
+                        f"the worst event loop lag for the last {LOOP_LAG_WINDOW} seconds",
+                       {"process": process_name, "val": lag}])
+
+    for func_name, count in exceptions_cnt.items():
+        metrics.append(["exceptions", "counter", "exceptions counter by function",
+                       {"function": func_name, "val": count}])
+
+    for filename, tasks in filename_to_tasks.items():
+        metrics.append(["active_tasks", "counter", "tasks by filename",
+                       {"filename": filename, "val": len(tasks)}])
+
+    for filename, count in active_tasks.items():
+        metrics.append(["active_tasks", "counter", "tasks by filename",
+                       {"filename": filename, "val": count}])
+
+    metrics.append(["delivery_retries", "counter", "retries of alert messages delivery",
+                    delivery_retries])
+
+    for reason, count in delivery_fails.items():
+        metrics.append(["delivery_fails", "counter", "undelivered alert messages by reason",
+                       {"reason": reason, "val": count}])
+
+    for filename, requests in http_requests.items():
+        metrics.append(["http_pool_hits", "counter",
+                        "requests of checks by pooled http clients on reused connections",
+                       {"filename": filename, "val": max(requests - http_connects[filename], 0)}])
+
+    for filename, connects in http_connects.items():
+        metrics.append(["http_pool_misses", "counter",
+                        "requests of checks by pooled http clients on new connections",
+                       {"filename": filename, "val": connects}])
+
+    for filename, duration in reload_duration.items():
+        metrics.append(["reload_seconds", "gauge", "how long the last reload took by filename",
+                       {"filename": filename, "val": duration}])
+
+    for filename, stall in reload_stall.items():
+        metrics.append(["reload_stall_seconds", "gauge",
+                        "how long the last reload held the event loop by filename",
+                       {"filename": filename, "val": stall}])
+
+    chunks = [render_metrics(metrics, openmetrics)]
+
+    name = "asmon_delivery_duration_seconds"
+    chunks.append(render_header(name, "histogram", "alert message delivery durations with retries",
+                                openmetrics))
+    chunks.append(render_histogram(name, "", delivery_durations).encode())
+
+    render_dirty_prefixes()
+    for name, m_type, desc in PREFIX_METRICS:
+        if not prefix_lines[name]:
+            continue
+        chunks.append(render_header("asmon_" + name, m_type, desc, openmetrics))
+        # the lines can change while the body is sent, the list holds the current ones
+        chunks.extend(prefix_lines[name].values())
+
+    if openmetrics:
+        chunks.append(b"# EOF\n")
+    return chunks
+
+
+async def read_request(reader):
+    """ returns method, http version and headers or None if the connection is closed """
+    MAX_HEADERS = 100
+
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+
+    method, path, version = request_line.decode("latin1").split()
+
+    headers = {}
+    for i in range(MAX_HEADERS):
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, _, value = line.decode("latin1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    else:
+        raise ValueError("too many headers")
+
+    return method, version, headers
+
+
+def accepts_gzip(accept_encoding):
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() != "gzip":
+            continue
+        params = params.replace(" ", "")
+        return not params.startswith("q=") or float(params[2:] or 0) > 0
+    return False
+
+
+def join_chunks(chunks):
+    """ joins small chunks into pieces of about MAX_PIECE_LEN """
+    MAX_PIECE_LEN = 64 * 1024
+
+    piece = []
+    piece_len = 0
+    for chunk in chunks:
+        piece.append(chunk)
+        piece_len += len(chunk)
+        if piece_len >= MAX_PIECE_LEN:
+            yield b"".join(piece)
+            piece = []
+            piece_len = 0
+    if piece:
+        yield b"".join(piece)
+
+
+async def send_metrics(writer, method, version, headers, keep_alive):
+    openmetrics = "application/openmetrics-text" in headers.get("accept", "")
+    gzipped = accepts_gzip(headers.get("accept-encoding", ""))
+    chunked = (version == "HTTP/1.1")
+
+    if openmetrics:
+        content_type = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+    else:
+        content_type = "text/plain; version=0.0.4; charset=utf-8"
 
     pkt_header_list = []
     pkt_header_list.append("HTTP/1.1 200 OK")
-    pkt_header_list.append("Connection: close")
-    pkt_header_list.append(f"Content-Length: {len(pkt_body_bytes)}")
-    pkt_header_list.append("Content-Type: text/plain; version=0.0.4; charset=utf-8")
+    pkt_header_list.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+    if chunked:
+        pkt_header_list.append("Transfer-Encoding: chunked")
+    if gzipped:
+        pkt_header_list.append("Content-Encoding: gzip")
+    pkt_header_list.append("Vary: Accept, Accept-Encoding")
+    pkt_header_list.append(f"Content-Type: {content_type}")
     pkt_header_list.append("Date: " + time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime()))
 
-    pkt_header_bytes = ("\r\n".join(pkt_header_list)).encode("utf8")
+    writer.write(("\r\n".join(pkt_header_list) + "\r\n\r\n").encode("utf8"))
+    if method == "HEAD":
+        await writer.drain()
+        return
+
+    compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if gzipped else None
+
+    def write_piece(piece):
+        if not piece:
+            return
+        if chunked:
+            writer.writelines([f"{len(piece):x}\r\n".encode(), piece, b"\r\n"])
+        else:
+            writer.write(piece)
+
+    for piece in join_chunks(make_metrics_body(openmetrics)):
+        if compressor:
+            piece = compressor.compress(piece)
+        write_piece(piece)
+        await writer.drain()
+        # drain doesn't yield if the transport isn't paused, let checks run between pieces
+        await asyncio.sleep(0)
 
-    pkt = pkt_header_bytes + b"\r\n\r\n" + pkt_body_bytes
-    return pkt
+    if compressor:
+        write_piece(compressor.flush())
+    if chunked:
+        writer.write(b"0\r\n\r\n")
+    await writer.drain()
 
 
 async def handle_metrics(reader, writer):
-    request = await reader.read(1024)
+    KEEPALIVE_TIMEOUT = 60
 
     client_ip = writer.get_extra_info("peername")[0]
     if IP_WHITELIST and client_ip not in IP_WHITELIST:
@@ -88,50 +492,52 @@ async def handle_metrics(reader, writer):
         return
 
     try:
-        metrics = []
-        metrics.append(["uptime", "counter", "asmon uptime", time.time() - START_TIME])
-        metrics.append(["tg_fails", "counter", "tg send fails", tg_fails])
-        metrics.append(["send_alert_queue_size", "gauge", "alert send queue", send_alert_queue_size])
-        metrics.append(["tasks", "gauge", "number of tasks", len(asyncio.all_tasks())])
-        metrics.append(['checks_total', "counter", "number of checks", sum(prefix_to_checks_cnt.values())])
-
-        active_alerts = sum(len(vals) for vals in prefix_to_id_to_alert.values())
-        metrics.append(['alerts_total', "counter", "number of active alerts", active_alerts])
-
-        for prefix, count in prefix_to_checks_cnt.items():
-            metrics.append(["checks", "counter", "checks counter by prefix",
-                           {"prefix": prefix_to_str(prefix), "val": count}])
-
-
-        for prefix, id_to_alert in prefix_to_id_to_alert.items():
-            metrics.append(["alerts", "counter", "active alerts counter by prefix",
-                           {"prefix": prefix_to_str(prefix), "val": len(id_to_alert)}])
-
-
-        for func_name, count in exceptions_cnt.items():
-            metrics.append(["exceptions", "counter", "exceptions counter by function",
-                           {"function": func_name, "val": count}])
-
-        for filename, tasks in filename_to_tasks.items():
-            metrics.append(["active_tasks", "counter", "tasks by filename",
-                           {"filename": filename, "val": len(tasks)}])
-
-        for prefix, name_to_val in user_metrics.items():
-            for name, val in name_to_val.items():
-                metrics.append(["metric", "gauge", "user metrics",
-                               {"prefix": prefix_to_str(prefix), "name": name, "val": val}])
-
-        pkt = make_metrics_pkt(metrics)
-
-        writer.write(pkt)
-        await writer.drain()
-
+        while True:
+            try:
+                request = await asyncio.wait_for(read_request(reader), KEEPALIVE_TIMEOUT)
+            except (asyncio.TimeoutError, ValueError):
+                break
+
+            if not request:
+                break
+
+            method, version, headers = request
+
+            connection = headers.get("connection", "").lower()
+            if version == "HTTP/1.1":
+                keep_alive = (connection != "close")
+            else:
+                # there is no chunked encoding in HTTP/1.0, the body ends with the connection
+                keep_alive = False
+
+            if method not in ("GET", "HEAD"):
+                writer.write(b"HTTP/1.1 405 Method Not Allowed\r\nAllow: GET, HEAD\r\n"
+                             b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+                break
+
+            await send_metrics(writer, method, version, headers, keep_alive)
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
     except Exception:
         traceback.print_exc()
     finally:
         writer.close()
 
 
+async def loop_lag_loop(process_name="main"):
+    loop = asyncio.get_running_loop()
+    lags = deque(maxlen=int(LOOP_LAG_WINDOW / LOOP_LAG_PAUSE))
+
+    while True:
+        start_time = loop.time()
+        await asyncio.sleep(LOOP_LAG_PAUSE)
+        lags.append(loop.time() - start_time - LOOP_LAG_PAUSE)
+        loop_lag[process_name] = max(lags)
+
+
 async def start_metrics_srv():
     if not IP_WHITELIST:
         log(f"to export metrics in the Prometheus format on port {METRICS_PORT}, specify IP_WHITELIST in config.py")
@@ -2,18 +2,161 @@
 # If you edit this file, it will be not autoreloaded
 
 import asyncio
+import socket
 import time
+import urllib.parse
+import weakref
 
+# resolved addresses are cached, failed resolves are cached for a shorter time
+DNS_TTL = 300
+DNS_NEGATIVE_TTL = 30
 
-async def get_cert_expire_days(host, port=443, timeout=10):
-    reader, writer = await asyncio.wait_for(
-        asyncio.open_connection(
-            host, port, ssl=True, server_hostname=host, limit=4096), timeout=timeout)
-    ssl_object = writer.get_extra_info("ssl_object")
-    writer.close()
-    cert = ssl_object.getpeercert()
+# (host, port) => (expire time, addresses or exception)
+dns_cache = {}
+# expired entries are evicted when the cache grows by DNS_CACHE_CLEAN_SIZE since the last clean
+DNS_CACHE_CLEAN_SIZE = 10000
+dns_cache_clean_size = DNS_CACHE_CLEAN_SIZE
+# (host, port) => future of the resolve in progress
+dns_in_flight = {}
+
+# the limit of simultaneous connections of all probes
+PROBE_CONCURRENCY = 500
+# loop => its semaphore, a semaphore can't be shared by loops, dry runs create a loop per checker
+probe_limits = weakref.WeakKeyDictionary()
+
+
+def get_probe_limit():
+    loop = asyncio.get_running_loop()
+    if loop not in probe_limits:
+        probe_limits[loop] = asyncio.Semaphore(PROBE_CONCURRENCY)
+    return probe_limits[loop]
+
+
+def clean_dns_cache():
+    global dns_cache_clean_size
+
+    cur_time = time.monotonic()
+    for key, (expire_time, _) in list(dns_cache.items()):
+        if expire_time <= cur_time:
+            del dns_cache[key]
+    dns_cache_clean_size = len(dns_cache) + DNS_CACHE_CLEAN_SIZE
+
+
+async def do_resolve(host, port):
+    if len(dns_cache) >= dns_cache_clean_size:
+        clean_dns_cache()
+
+    loop = asyncio.get_running_loop()
+    try:
+        infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        addrs = [(family, sockaddr) for family, type, proto, canonname, sockaddr in infos]
+        dns_cache[(host, port)] = (time.monotonic() + DNS_TTL, addrs)
+        return addrs
+    except OSError as E:
+        dns_cache[(host, port)] = (time.monotonic() + DNS_NEGATIVE_TTL, E)
+        raise
+    finally:
+        del dns_in_flight[(host, port)]
+
+
+async def resolve(host, port=0):
+    """ returns the list of (family, sockaddr) of the host, simultaneous resolves are merged """
+    cached = dns_cache.get((host, port))
+    if cached and cached[0] > time.monotonic():
+        if isinstance(cached[1], Exception):
+            raise cached[1].with_traceback(None)
+        return cached[1]
+
+    if (host, port) not in dns_in_flight:
+        dns_in_flight[(host, port)] = asyncio.ensure_future(do_resolve(host, port))
+    # the resolve is not cancelled if the caller is
+    return await asyncio.shield(dns_in_flight[(host, port)])
+
+
+async def open_connection(host, port, ssl=None, timeout=10):
+    """ like asyncio.open_connection, but uses cached addresses """
+    addrs = await resolve(host, port)
+
+    last_error = None
+    for family, sockaddr in addrs:
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_connection(sockaddr[0], port, ssl=ssl, family=family,
+                                        server_hostname=host if ssl else None, limit=4096),
+                timeout=timeout)
+        except (OSError, asyncio.TimeoutError) as E:
+            last_error = E
+    raise last_error
+
+
+def cert_expire_days(writer):
+    cert = writer.get_extra_info("ssl_object").getpeercert()
 
     TIME_FMT = "%b %d %H:%M:%S %Y %Z"
     expire_time = time.mktime(time.strptime(cert["notAfter"], TIME_FMT))
-    days_left = (expire_time - time.time())/60/60/24
-    return days_left
+    return (expire_time - time.time())/60/60/24
+
+
+async def get_cert_expire_days(host, port=443, timeout=10):
+    reader, writer = await open_connection(host, port, ssl=True, timeout=timeout)
+    try:
+        return cert_expire_days(writer)
+    finally:
+        writer.close()
+
+
+async def probe(targets, probe_func, timeout):
+    """ returns target => result of probe_func or its exception """
+    probe_limit = get_probe_limit()
+
+    async def probe_target(target):
+        async with probe_limit:
+            return await asyncio.wait_for(probe_func(target), timeout)
+
+    results = await asyncio.gather(*[probe_target(target) for target in targets],
+                                   return_exceptions=True)
+    return dict(zip(targets, results))
+
+
+async def probe_tcp(targets, timeout=10):
+    """ targets are (host, port), returns target => connect time in seconds or exception """
+    async def connect(target):
+        start_time = time.monotonic()
+        reader, writer = await open_connection(*target, timeout=timeout)
+        writer.close()
+        return time.monotonic() - start_time
+
+    return await probe(targets, connect, timeout)
+
+
+async def probe_certs(targets, timeout=10):
+    """ targets are hosts or (host, port), returns target => days before the certificate
+        expires or exception """
+    async def get_days(target):
+        host, port = (target, 443) if isinstance(target, str) else target
+        return await get_cert_expire_days(host, port, timeout=timeout)
+
+    return await probe(targets, get_days, timeout)
+
+
+async def probe_http(urls, timeout=10):
+    """ returns url => http status code of GET request or exception, redirects are not followed """
+    async def get_status(url):
+        url_parts = urllib.parse.urlsplit(url)
+        is_https = url_parts.scheme == "https"
+        port = url_parts.port or (443 if is_https else 80)
+        path = url_parts.path or "/"
+        if url_parts.query:
+            path += "?" + url_parts.query
+
+        reader, writer = await open_connection(url_parts.hostname, port, ssl=is_https or None,
+                                               timeout=timeout)
+        try:
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {url_parts.netloc}\r\n"
+                         f"Connection: close\r\nUser-Agent: asmon\r\n\r\n".encode())
+            status_line = await reader.readline()
+            return int(status_line.split()[1])
+        finally:
+            writer.close()
+
+    return await probe(urls, get_status, timeout)
@@ -0,0 +1,136 @@
+# watches a directory with inotify, used to reload changed files without polling
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+import time
+
+from .commons import log
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# wait for this quiet time after the last event, files are often written in several steps
+DEBOUNCE = 0.5
+MAX_DEBOUNCE = 5
+
+libc = None
+
+
+class Watcher:
+    def __init__(self, directory, name_filter):
+        self.directory = directory
+        self.name_filter = name_filter
+        self.changed = set()
+        self.need_rescan = False
+        self.event = asyncio.Event()
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        try:
+            self.add_watch()
+        except Exception:
+            os.close(self.fd)
+            raise
+
+        asyncio.get_running_loop().add_reader(self.fd, self.on_readable)
+
+    def add_watch(self):
+        self.wd = libc.inotify_add_watch(self.fd, os.fsencode(self.directory), WATCH_MASK)
+        if self.wd < 0:
+            self.wd = None
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch {self.directory} failed")
+
+    def on_readable(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = os.fsdecode(data[pos:pos + name_len].rstrip(b"\0"))
+            pos += name_len
+
+            if mask & (IN_Q_OVERFLOW | IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                # events are lost or the directory is gone
+                self.need_rescan = True
+                if mask & IN_IGNORED:
+                    self.wd = None
+                self.event.set()
+            elif name and self.name_filter(name):
+                self.changed.add(name)
+                self.event.set()
+
+    async def wait_changes(self, timeout):
+        """ returns the names of changed files or None if all files should be rescanned """
+        if self.wd is None:
+            try:
+                self.add_watch()
+            except OSError:
+                await asyncio.sleep(timeout)
+                return None
+
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+        deadline = time.monotonic() + MAX_DEBOUNCE
+        while time.monotonic() < deadline:
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(),
+                                       min(DEBOUNCE, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                break
+        self.event.clear()
+
+        changed, self.changed = self.changed, set()
+        if self.need_rescan:
+            self.need_rescan = False
+            return None
+        return changed
+
+    def close(self):
+        asyncio.get_running_loop().remove_reader(self.fd)
+        os.close(self.fd)
+
+
+def watch_directory(directory, name_filter):
+    """ returns the watcher or None if inotify is not available and polling should be used """
+    global libc
+
+    if not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        if libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        return Watcher(directory, name_filter)
+    except Exception as E:
+        log(f"failed to watch {directory} with inotify, polling it: {E}")
+        return None
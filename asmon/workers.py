@@ -0,0 +1,66 @@
+# transport between the main process and worker processes, see run in core.py
+import asyncio
+import os
+import pickle
+import socket
+import struct
+import sys
+import zlib
+
+parent_writer = None  # set in worker processes
+parent_drain_lock = None
+
+
+def in_shard(filename, worker_idx, workers_cnt):
+    return zlib.crc32(filename.encode()) % workers_cnt == worker_idx
+
+
+async def spawn_worker(directory, worker_idx, workers_cnt):
+    """ returns the worker process and the stream with its messages """
+    parent_sock, child_sock = socket.socketpair()
+
+    code = (f"import asmon.core; asmon.core.worker_main({directory!r}, {worker_idx}, "
+            f"{workers_cnt}, {child_sock.fileno()})")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+
+    try:
+        proc = await asyncio.create_subprocess_exec(sys.executable, "-c", code, env=env,
+                                                    pass_fds=[child_sock.fileno()])
+    except Exception:
+        parent_sock.close()
+        raise
+    finally:
+        child_sock.close()
+
+    reader, writer = await asyncio.open_connection(sock=parent_sock)
+    return proc, reader, writer
+
+
+async def connect_to_parent(fd):
+    global parent_writer
+    global parent_drain_lock
+
+    reader, parent_writer = await asyncio.open_connection(sock=socket.socket(fileno=fd))
+    parent_drain_lock = asyncio.Lock()
+    return reader
+
+
+def send_to_parent(msg):
+    data = pickle.dumps(msg)
+    parent_writer.write(struct.pack("!I", len(data)) + data)
+
+
+async def drain_parent():
+    """ waits while the parent is slow to read, so the buffer of the worker doesn't grow """
+    # concurrent drains of one writer are not supported before python 3.12
+    async with parent_drain_lock:
+        await parent_writer.drain()
+
+
+async def read_msg(reader):
+    """ returns None if the worker has exited """
+    try:
+        header = await reader.readexactly(4)
+        return pickle.loads(await reader.readexactly(struct.unpack("!I", header)[0]))
+    except asyncio.IncompleteReadError:
+        return None
@@ -0,0 +1,158 @@
+# measures the memory of active alerts with their indexes, run from the repo root:
+# python benchmarks/alerts_memory.py
+import heapq
+import itertools
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from dataclasses import dataclass
+
+sys.path.insert(0, ".")
+from asmon import alerts
+from asmon.alerts import Alert
+from asmon.commons import prefix_to_alerts
+
+ALERTS_CNT = 100000
+# the alerts are renotified, so they stay in the due time index, and their send times are
+# spread over an hour
+RENOTIFY = 3600
+
+
+@dataclass
+class DictAlert:
+    """ the alert before it was slotted """
+    filename: str
+    funcname: str
+    funcarg: object
+    alert_id: str
+    text: str
+    start_time: float
+    last_update_time: float
+    last_send_time: float = 0
+    renotify: float = float("inf")
+    in_a_row: int = 0
+    notify_if_in_a_row: int = 1
+    is_event: bool = False
+    recovered: bool = False
+
+    @property
+    def prefix(self):
+        return (self.filename, self.funcname, self.funcarg)
+
+
+def make_prefixes():
+    return [("check_hosts.py", "check_host", f"host{i}") for i in range(ALERTS_CNT)]
+
+
+def send_time(num, cur_time):
+    return cur_time - num * RENOTIFY / ALERTS_CNT
+
+
+def measure_before():
+    """ dict alerts in a dict per prefix, indexed by (prefix, alert_id) tuples in a dict and
+        a heap """
+    prefixes = make_prefixes()
+    cur_time = time.time()
+
+    tracemalloc.start()
+    alerts_list = []
+    for num, (filename, funcname, funcarg) in enumerate(prefixes):
+        alerts_list.append(DictAlert(filename=filename, funcname=funcname, funcarg=funcarg,
+                                     alert_id="default", text="host is down",
+                                     start_time=cur_time, last_update_time=time.time(),
+                                     last_send_time=send_time(num, cur_time),
+                                     renotify=RENOTIFY, in_a_row=1))
+    alerts_size = tracemalloc.get_traced_memory()[0]
+
+    prefix_to_id_to_alert = defaultdict(dict)
+    filename_to_alert_prefixes = defaultdict(set)
+    for alert in alerts_list:
+        prefix_to_id_to_alert[alert.prefix][alert.alert_id] = alert
+        filename_to_alert_prefixes[alert.filename].add(alert.prefix)
+    stored_size = tracemalloc.get_traced_memory()[0]
+
+    due_alerts = []
+    due_alerts_seq = itertools.count()
+    alert_key_to_due_time = {}
+    for alert in alerts_list:
+        key = (alert.prefix, alert.alert_id)
+        due_time = alert.last_send_time + alert.renotify
+        alert_key_to_due_time[key] = due_time
+        heapq.heappush(due_alerts, (due_time, next(due_alerts_seq), key))
+    total_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start_time = time.perf_counter()
+    for id_to_alert in prefix_to_id_to_alert.values():
+        for alert in id_to_alert.values():
+            alert.prefix
+    prefix_time = time.perf_counter() - start_time
+
+    return alerts_size, stored_size, total_size, prefix_time
+
+
+def measure_now():
+    """ slotted alerts stored and indexed by asmon.alerts """
+    prefixes = make_prefixes()
+    cur_time = time.time()
+
+    tracemalloc.start()
+    alerts_list = []
+    for num, prefix in enumerate(prefixes):
+        alerts_list.append(Alert(prefix=prefix, alert_id="default", text="host is down",
+                                 start_time=cur_time, last_update_time=time.time(),
+                                 last_send_time=send_time(num, cur_time),
+                                 renotify=RENOTIFY, in_a_row=1))
+    alerts_size = tracemalloc.get_traced_memory()[0]
+
+    for alert in alerts_list:
+        alerts.add_alert(alert)
+    stored_size = tracemalloc.get_traced_memory()[0]
+
+    for alert in alerts_list:
+        alerts.index_alert(alert)
+    total_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start_time = time.perf_counter()
+    for alerts_of_prefix in prefix_to_alerts.values():
+        for alert in alerts_of_prefix:
+            alert.prefix
+    prefix_time = time.perf_counter() - start_time
+
+    return alerts_size, stored_size, total_size, prefix_time
+
+
+def measure_healthy_checks():
+    """ the memory left by the postcheck hook for checks without alerts, before and now """
+    prefixes = [("check_hosts.py", "check_host", f"healthy{i}") for i in range(ALERTS_CNT)]
+
+    tracemalloc.start()
+    prefix_to_id_to_alert = defaultdict(dict)
+    for prefix in prefixes:
+        list(prefix_to_id_to_alert[prefix].values())
+    before_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    for prefix in prefixes:
+        list(prefix_to_alerts.get(prefix, ()))
+    now_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return before_size, now_size
+
+
+if __name__ == "__main__":
+    results = {}
+    for name, measure in (("before", measure_before), ("now", measure_now)):
+        alerts_size, stored_size, total_size, prefix_time = results[name] = measure()
+        print(f"{name:6} {alerts_size / ALERTS_CNT:6.1f} bytes per alert, "
+              f"{stored_size / ALERTS_CNT:6.1f} stored, "
+              f"{total_size / ALERTS_CNT:6.1f} with the due time index, "
+              f"prefix access {prefix_time / ALERTS_CNT * 1e9:5.1f} ns")
+    print(f"the full footprint is {results['before'][2] / results['now'][2]:.1f} times smaller")
+
+    before_size, now_size = measure_healthy_checks()
+    print(f"checks without alerts: {before_size / ALERTS_CNT:.1f} bytes per check before, "
+          f"{now_size / ALERTS_CNT:.1f} now")
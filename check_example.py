@@ -8,7 +8,7 @@ import json
 
 import httpx
 
-from asmon import checker, alert, metric, useful_checks
+from asmon import checker, alert, metric, http_client, useful_checks
 
 
 @checker(pause=5)
@@ -60,15 +60,15 @@ async def just_check():
 #     """
 #     More complex checks, shows how easy you can write custom checks
 #     renotify is a reminder period for alerts in seconds
+#     http_client() reuses connections between runs
 #     """
 #     try:
-#         async with httpx.AsyncClient() as client:
-#             resp = await client.get("https://reqres.in/api/users", timeout=300)
-#             if resp.status_code != 200:
-#                 alert(f"test rest-service returned bad answer status {resp.status_code}")
-#                 return
-#             if "data" not in resp.json():
-#                 alert(f"test rest-service returned json without 'data' field")
+#         resp = await http_client().get("https://reqres.in/api/users", timeout=300)
+#         if resp.status_code != 200:
+#             alert(f"test rest-service returned bad answer status {resp.status_code}")
+#             return
+#         if "data" not in resp.json():
+#             alert(f"test rest-service returned json without 'data' field")
 #     except httpx.RequestError as E:
 #         alert(f"test rest-service is unavailable {E}")
 #     except json.decoder.JSONDecodeError:
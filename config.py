@@ -10,8 +10,23 @@ METRICS_PORT = 9325
 # whitelist for metrics
 IP_WHITELIST = []
 
+# optional limits of simultaneously running checks, 0 means no limit
+MAX_CONCURRENT_CHECKS = 0
+MAX_CONCURRENT_CHECKS_PER_FILE = 0
+
+# if more alerts of one checker function are sent at once, a summary alert is sent instead,
+# 0 means no summaries, e.g. 20
+ALERT_STORM_THRESHOLD = 0
+
+# number of worker processes to run checks in, 0 means run them in the main process
+WORKERS = 0
+
 # timezone
 TIMEZONE = "Asia/Yekaterinburg"
 
 # language, valid values are EN, RU
 LANGUAGE = "EN"
+
+# sizes of the pools shared by checkers with executor="thread" and executor="process"
+EXECUTOR_THREADS = 32
+EXECUTOR_PROCESSES = 4
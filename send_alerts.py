@@ -13,9 +13,10 @@ at least one alert and mark it as sent by updating last_send_time of this alert.
 
 import asyncio
 import time
+import traceback
 
 from config import BOT_TOKEN, TG_DEST_ID, LANGUAGE
-from asmon import log
+from asmon import log, metrics, SurviveReloadsVar
 
 import httpx
 
@@ -23,19 +24,44 @@ import httpx
 MAX_TG_MSG_LEN = 4096
 MAX_ALERT_MSG_LEN = 1024
 
+# Telegram limits: a message per second to a chat and 30 messages per second in total
+TG_CHAT_MSGS_PER_SEC = 1
+TG_MSGS_PER_SEC = 30
+
+TG_TIMEOUT = 30
+TG_RETRIES = 3
+TG_RETRY_PAUSE = 1  # doubled after every retry
+
+# the connections to Telegram are reused, also after reloads of this file
+tg_client_var = SurviveReloadsVar("tg_client", None)
+
+# chat id or ALL_CHATS => when the next message can be sent, by time.monotonic()
+ALL_CHATS = "all chats"
+next_send_time = SurviveReloadsVar("tg_next_send_time", {}).get()
+
 
 async def send_alerts(alerts):
     """ Alert sending logic is here """
     group_to_alerts = group_alerts(alerts)
 
-    for group, alerts_in_group in group_to_alerts.items():
-        msg, alerts_to_send = format_alerts(alerts_in_group)
-        if not msg:
-            continue
-        success = await send_msg(TG_DEST_ID, msg, BOT_TOKEN)
-        if success:
-            for alert in alerts_to_send:
-                alert.last_send_time = time.time()
+    async def send_group(alerts_in_group):
+        # all alerts of the group are sent, the messages go one by one to keep their order
+        for msg, alerts_to_send in format_alerts(alerts_in_group):
+            success = await send_msg(TG_DEST_ID, msg, BOT_TOKEN)
+            if success:
+                for alert in alerts_to_send:
+                    alert.last_send_time = time.time()
+
+    # groups are sent concurrently, send_msg keeps the rate limits. A failed group doesn't
+    # stop the others, its alerts stay unsent and are sent again in the next cycle
+    results = await asyncio.gather(*[send_group(alerts_in_group)
+                                     for alerts_in_group in group_to_alerts.values()],
+                                   return_exceptions=True)
+    for group, result in zip(group_to_alerts, results):
+        if isinstance(result, Exception):
+            log(f"Failed to send alerts of {group}: {result!r}")
+            traceback.print_exception(result)
+            metrics.exceptions_cnt["alert_sender"] += 1
 
 
 def group_alerts(alerts):
@@ -52,37 +78,98 @@ def get_alert_group(alert):
     return alert.filename
 
 
+def get_tg_client():
+    client = tg_client_var.get()
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(timeout=TG_TIMEOUT)
+        tg_client_var.set(client)
+    return client
+
+
+def reserve_send_slot(chat_id):
+    """ returns the time when a message to the chat can be sent without breaking the limits """
+    slot = max(time.monotonic(), next_send_time.get(chat_id, 0), next_send_time.get(ALL_CHATS, 0))
+    next_send_time[chat_id] = slot + 1 / TG_CHAT_MSGS_PER_SEC
+    next_send_time[ALL_CHATS] = slot + 1 / TG_MSGS_PER_SEC
+    return slot
+
+
+def get_retry_after(resp):
+    try:
+        return resp.json()["parameters"]["retry_after"]
+    except Exception:
+        return 0
+
+
 async def send_msg(user_id, text, token=BOT_TOKEN):
     log("send_msg", user_id, text)
 
     url = "https://api.telegram.org/bot%s/sendMessage" % token
     payload = {"chat_id": user_id, "text": text,}
 
-    try:
-        async with httpx.AsyncClient() as client:
-            resp = httpx.post(url, json=payload)
-            if resp.status_code != 200:
-                log(f"Failed to send msg to {user_id}: {text} " +
-                    f"{resp.status_code} {resp.text}")
-            return resp.status_code == 200
-    except OSError:
-        traceback.print_exc()
-        return False
+    start_time = time.monotonic()
+    retry_pause = TG_RETRY_PAUSE
+    fail_reason = None
+    for retry in range(TG_RETRIES + 1):
+        if retry:
+            await asyncio.sleep(retry_pause)
+            retry_pause *= 2
+
+        await asyncio.sleep(reserve_send_slot(user_id) - time.monotonic())
+        try:
+            resp = await get_tg_client().post(url, json=payload)
+        except (httpx.HTTPError, OSError) as E:
+            log(f"Failed to send msg to {user_id}: {text} {E!r}")
+            fail_reason = "network"
+            continue
+
+        if resp.status_code == 200:
+            fail_reason = None
+            break
+
+        log(f"Failed to send msg to {user_id}: {text} " +
+            f"{resp.status_code} {resp.text}")
+
+        if resp.status_code == 429:
+            fail_reason = "too_many_requests"
+            retry_pause = max(retry_pause, get_retry_after(resp))
+            # the other messages to this chat should wait too
+            next_send_time[user_id] = max(next_send_time.get(user_id, 0),
+                                          time.monotonic() + retry_pause)
+        elif resp.status_code >= 500:
+            fail_reason = "server_error"
+        else:
+            # the request is wrong, retries will not help
+            fail_reason = f"http_{resp.status_code}"
+            break
+
+    metrics.observe_delivery(time.monotonic() - start_time, retry, fail_reason)
+    return fail_reason is None
 
 
 def format_alerts(alerts):
-    msg = ""
+    """ returns the list of messages with the alerts in them """
+    messages = []
+    lines = []
+    msg_len = 0
     chosen_alerts = []
 
     for alert in alerts:
         curr_msg = format_alert(alert, lang=LANGUAGE)
 
-        if len(msg) + len(curr_msg) + 1 >= MAX_TG_MSG_LEN:
-            break
+        if lines and msg_len + len(curr_msg) + 1 >= MAX_TG_MSG_LEN:
+            messages.append(("".join(lines), chosen_alerts))
+            lines = []
+            msg_len = 0
+            chosen_alerts = []
 
-        msg += curr_msg + "\n"
+        lines.append(curr_msg + "\n")
+        msg_len += len(curr_msg) + 1
         chosen_alerts.append(alert)
-    return msg, chosen_alerts
+
+    if lines:
+        messages.append(("".join(lines), chosen_alerts))
+    return messages
 
 
 def format_alert(alert, lang, max_len=MAX_ALERT_MSG_LEN):